@@ -16,9 +16,11 @@ from flask.ext.security.registerable import register_user
 from werkzeug.local import LocalProxy
 
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, joinedload_all, subqueryload
 
 from flamaster.core import http
-from flamaster.core.decorators import method_wrapper
+from flamaster.core.counting import CachedCount
+from flamaster.core.decorators import current_language, method_wrapper
 from flamaster.core.resources import Resource, ModelResource
 from flamaster.core.utils import jsonify_status_code
 
@@ -29,6 +31,10 @@ __all__ = ['SessionResource', 'ProfileResource', 'RoleResource']
 
 security = LocalProxy(lambda: current_app.extensions['security'])
 
+# loader options shared by the resources loading plans
+with_customer = joinedload('customer')
+with_roles = subqueryload('roles')
+
 
 class CustomerMixin(object):
 
@@ -99,12 +105,15 @@ class SessionResource(Resource):
             cuid = session.get('customer_id')
         else:
             cuid = current_user.customer.id
+        # the id is handed to the client, so the session is stored even if
+        # nothing is put into it yet, to keep the id for the next requests
+        session.persist()
         response = {
-            'id': session['id'],
+            'id': session.sid,
             'is_anonymous': current_user.is_anonymous(),
             'uid': session.get('user_id'),
             'cuid': cuid,
-            'locale': g.locale
+            'locale': current_language()
         }
         response.update(kwargs)
         return response
@@ -116,6 +125,15 @@ class ProfileResource(ModelResource):
                          'last_name': t.String,
                          'phone': t.String}).ignore_extra('*')
     model = User
+    count_strategy = CachedCount()
+    load_options = {
+        'first_name': [with_customer],
+        'last_name': [with_customer],
+        'phone': [with_customer],
+        'billing_address': [joinedload_all('customer._billing_address')],
+        'is_superuser': [with_roles],
+        'roles': [with_roles],
+    }
 
     method_decorators = {
         'put': [login_required],
@@ -192,6 +210,11 @@ class ProfileResource(ModelResource):
         qs = super(ProfileResource, self).get_objects(**kwargs)
         return qs.filter(or_(*filters))
 
+    def prefetch(self, items):
+        super(ProfileResource, self).prefetch(items)
+        if self.fields is None or 'products' in self.fields:
+            User.prefetch_product_counts(items)
+
     def serialize(self, instance, include=None):
         exclude = ['email']
 
@@ -199,11 +222,12 @@ class ProfileResource(ModelResource):
             if current_user.id == instance.id or current_user.is_superuser():
                 exclude = []
 
-        return instance.as_dict(include, exclude)
+        return instance.as_dict(include, exclude, self.fields)
 
 
 class AddressResource(ModelResource, CustomerMixin):
     model = Address
+    load_options = {'type': [with_customer]}
     validation = t.Dict({
         'country_id': t.Int,
         'apartment': t.Or(t.String(allow_blank=True), t.Null),
@@ -278,6 +302,8 @@ class BankAccountResource(ModelResource):
 
 class CustomerResource(ModelResource, CustomerMixin):
     model = Customer
+    count_strategy = CachedCount()
+    etag_column = 'updated_at'
 
     method_decorators = {'delete': roles_required('admin')}
 
@@ -53,11 +53,15 @@ class Address(db.Model, CRUDMixin):
 
     type = property(_type_get, lambda x, y: None)
 
-    def as_dict(self, include=None, exclude=None):
+    @classmethod
+    def serializable_fields(cls):
+        return super(Address, cls).serializable_fields() | set(['type'])
+
+    def as_dict(self, include=None, exclude=None, only=None):
         include = include or []
         include.extend(['type'])
 
-        return super(Address, self).as_dict(include, exclude)
+        return super(Address, self).as_dict(include, exclude, only)
 
 
 user_roles = db.Table('user_roles', db.metadata,
@@ -84,7 +88,8 @@ class Customer(db.Model, CRUDMixin):
     fax = db.Column(db.String(80), default='')
     gender = db.Column(db.String(1), default='')
     company = db.Column(db.Unicode(255), default=u'')
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     notes = db.Column(db.UnicodeText)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     user = db.relationship("User", backref=db.backref("customer",
@@ -209,6 +214,8 @@ class User(db.Model, CRUDMixin, UserMixin):
 
     roles = db.relationship('Role', secondary=user_roles,
                                 backref=db.backref('users', lazy='dynamic'))
+    # amount of created products, kept once counted or prefetched
+    _product_count = None
 
     def __repr__(self):
         return "<User: %r>" % self.email
@@ -298,17 +305,54 @@ class User(db.Model, CRUDMixin, UserMixin):
 
     @property
     def product_count(self):
-        return BaseProduct.objects(created_by=self.id).count()
+        if self._product_count is None:
+            self._product_count = \
+                BaseProduct.objects(created_by=self.id).count()
+        return self._product_count
+
+    @classmethod
+    def prefetch_product_counts(cls, users):
+        """ Counts products created by each of the `users` with the single
+            aggregation, so `product_count` doesn't query mongo per user
+        """
+        users = [user for user in users if user._product_count is None]
+        if not users:
+            return
+
+        match = BaseProduct.objects(
+            created_by__in=[user.id for user in users])._query
+        result = BaseProduct._get_collection().aggregate([
+            {'$match': match},
+            {'$group': {'_id': '$created_by', 'count': {'$sum': 1}}}
+        ])
+        # pymongo before 3.0 returns the command response, not the cursor
+        if isinstance(result, dict):
+            result = result['result']
+
+        counts = dict((row['_id'], row['count']) for row in result)
+        for user in users:
+            user._product_count = counts.get(user.id, 0)
+
+    # exported in addition to the columns, and columns kept private
+    exported_fields = ['first_name', 'last_name', 'phone', 'billing_address',
+                       'is_superuser', 'roles']
+    private_fields = ['password', 'remember_token', 'authentication_token']
+
+    @classmethod
+    def serializable_fields(cls):
+        fields = super(User, cls).serializable_fields()
+        fields.update(cls.exported_fields + ['products'])
+        return fields - set(cls.private_fields)
 
-    def as_dict(self, include=None, exclude=None):
+    def as_dict(self, include=None, exclude=None, only=None):
         include, exclude = include or [], exclude or []
-        exclude.extend(['password', 'remember_token', 'authentication_token'])
-        include.extend(['first_name', 'last_name', 'phone', 'billing_address',
-                        'is_superuser', 'roles'])
+        exclude.extend(self.private_fields)
+        include.extend(self.exported_fields)
 
-        result = super(User, self).as_dict(include, exclude)
+        result = super(User, self).as_dict(include, exclude, only)
 
-        result['products'] = {'created': self.product_count}
+        if only is None or 'products' in only:
+            result['products'] = {'created': self.product_count}
 
         return result
 
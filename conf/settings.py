@@ -81,6 +81,14 @@ MONGODB_FALLBACK_LANG = BABEL_DEFAULT_LOCALE
 # ----------------
 
 ELASTICSEARCH_URL = "http://localhost:9200/"
+# search without elasticsearch, in the index kept by every process and
+# saved to the snapshots under INDEX_EMBEDDED_PATH (instance/index/ if None)
+INDEX_EMBEDDED = False
+INDEX_EMBEDDED_PATH = None
+
+# read sessions pickled before the binary session codec, only for the
+# migration period: pickled data from the shared redis isn't safe to load
+SESSION_LEGACY_PICKLE = False
 
 DEFAULT_PAGE_SIZE = 100
 # Flask-Mail sender for default email sender
@@ -9,6 +9,7 @@ from .utils import jsonify_status_code
 
 @api_resource(core, 'locale', {'short': None})
 class LocaleResource(Resource):
+    cache_policy = {'get': 3600}
 
     def get(self, short=None):
         locale = get_locale()
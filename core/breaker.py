@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+from threading import Lock
+
+from requests.exceptions import ConnectionError, Timeout
+
+
+__all__ = ['CircuitBreaker', 'CircuitOpenError', 'GuardedClient']
+
+
+class CircuitOpenError(ConnectionError):
+    """ Raised instead of calling the service while the circuit is open, it
+        is handled as the connection error to the service
+    """
+
+
+class CircuitBreaker(object):
+    """ Stops calling the failing service for a while. Circuit opens after
+        `threshold` failures in a row and calls fail immediately for
+        `timeout` seconds. Then single probe call is let through: circuit is
+        closed if it succeeds and opened again otherwise
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, timeout=30, errors=(ConnectionError,
+                                                        Timeout)):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.errors = errors
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.timeout):
+                # this call is the probe, others wait for its result
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError("Circuit is {}".format(self.state))
+
+    def _on_success(self):
+        with self._lock:
+            self.state, self.failures = self.CLOSED, 0
+
+    def _on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.threshold):
+                self.state, self.opened_at = self.OPEN, time.time()
+
+    def call(self, func, *args, **kwargs):
+        self._before_call()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except self.errors:
+            failed = True
+            self._on_failure()
+            raise
+        finally:
+            # any response, even the error one, means the service is up
+            if not failed:
+                self._on_success()
+
+
+class GuardedClient(object):
+    """ Proxy passing method calls of the `client` through the breaker
+    """
+
+    def __init__(self, client, breaker):
+        self.client = client
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def guarded(*args, **kwargs):
+            return self.breaker.call(attr, *args, **kwargs)
+        return guarded
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flamaster.extensions import redis
+
+from .signals import model_changed
+
+
+VERSION_PREFIX = 'version:'
+
+
+def storage_name(model):
+    """ Name of the table or collection the model class is stored in, it is
+        used as the invalidation tag for everything cached from the model
+    """
+    if hasattr(model, '_get_collection_name'):
+        return model._get_collection_name()
+    return model.__tablename__
+
+
+def model_tags(model):
+    """ Invalidation tags for data read from the model, including table
+        of translations for `multilingual` models
+    """
+    tags = [storage_name(model)]
+    localized = getattr(model, '__localized__', None)
+    if localized is not None:
+        tags.append(storage_name(localized))
+    return tags
+
+
+def get_versions(*tags):
+    """ Current versions of the passed tags, every cache key built with
+        versions gets stale as soon as any of its tags is invalidated
+    """
+    if not tags:
+        return []
+    versions = redis.mget([VERSION_PREFIX + tag for tag in tags])
+    return [int(version or 0) for version in versions]
+
+
+def invalidate(*tags):
+    pipe = redis.pipeline(transaction=False)
+    for tag in tags:
+        pipe.incr(VERSION_PREFIX + tag)
+    pipe.execute()
+
+
+@model_changed.connect
+def invalidate_model(sender, instance=None):
+    invalidate(storage_name(sender))
+
+
+class LRUCache(object):
+    """ Thread safe in-process mapping keeping up to `size` recently used
+        values, each value expires after the timeout it was set with
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time.time():
+                return None
+            # re-inserted item becomes the most recently used one
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.size:
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + timeout, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TwoTierCache(object):
+    """ Cache of string values with the per-process LRU in front of redis
+        shared by all workers. Values are never invalidated in place, so
+        keys should include `get_versions` of the tags values depend on
+    """
+
+    def __init__(self, prefix, size=512):
+        self.prefix = prefix
+        self.local = LRUCache(size)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        redis_key = self.prefix + key
+        pipe = redis.pipeline(transaction=False)
+        pipe.get(redis_key)
+        pipe.ttl(redis_key)
+        value, timeout = pipe.execute()
+
+        if value is not None and timeout > 0:
+            self.local.set(key, value, timeout)
+        return value
+
+    def set(self, key, value, timeout):
+        self.local.set(key, value, timeout)
+        redis.setex(self.prefix + key, timeout, value)
+
+
+response_cache = TwoTierCache('response:')
+
+
+class TranslationCache(object):
+    """ Localized fields values of multilingual models kept in redis by the
+        model, instance id and locale. Values of the instance translation
+        are stored in one hash, missing translation is stored as empty one
+    """
+    prefix = 'translation:'
+    # hash can't be empty, this field marks translations known to be absent
+    empty = '_'
+
+    def __init__(self, timeout=3600):
+        self.timeout = timeout
+
+    def get_key(self, model, id, locale):
+        return "{}{}:{}:{}".format(self.prefix, storage_name(model), id,
+                                   locale)
+
+    def get_many(self, model, ids, locale):
+        """ Returns dictionary of the cached values by instance ids, ids
+            missing in the cache are omitted
+        """
+        pipe = redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self.get_key(model, id, locale))
+
+        cached = {}
+        for id, values in zip(ids, pipe.execute()):
+            if values:
+                values.pop(self.empty, None)
+                cached[id] = dict((field, value.decode('utf-8'))
+                                  for field, value in values.iteritems())
+        return cached
+
+    def set_many(self, model, translations, locale):
+        pipe = redis.pipeline(transaction=False)
+        for id, values in translations.iteritems():
+            key = self.get_key(model, id, locale)
+            values = dict((field, value.encode('utf-8'))
+                          for field, value in values.iteritems()
+                          if value is not None)
+            pipe.hmset(key, values or {self.empty: ''})
+            pipe.expire(key, self.timeout)
+        pipe.execute()
+
+    def delete(self, model, id, locale):
+        redis.delete(self.get_key(model, id, locale))
+
+
+translation_cache = TranslationCache()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+from speaklater import _LazyString
+
+
+__all__ = ['SessionCodec']
+
+EPOCH = datetime(1970, 1, 1)
+DOUBLE = struct.Struct('<d')
+
+
+def write_varint(number, write):
+    while number > 0x7f:
+        write(chr(number & 0x7f | 0x80))
+        number >>= 7
+    write(chr(number))
+
+
+def read_varint(data, position):
+    number = shift = 0
+    while True:
+        byte = ord(data[position])
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def zigzag(number):
+    if number < 0:
+        return (-number << 1) - 1
+    return number << 1
+
+
+def unzigzag(number):
+    if number & 1:
+        return -((number + 1) >> 1)
+    return number >> 1
+
+
+class SessionCodec(object):
+    """ Compact binary encoding of the session data. Every value is written
+        as the tag byte followed by its payload: integers and lengths are
+        varints, containers are prefixed with the amount of items. Encoded
+        data starts with the format version and flags bytes, data larger
+        than `threshold` bytes is compressed if it gets smaller.
+
+        Data written in any other format is rejected, unless the `legacy`
+        serializer is passed to load it, e.g. pickle for sessions stored
+        before the codec was introduced, while they are not expired yet
+    """
+    version = 1
+    COMPRESSED = 0x01
+
+    constants = {'N': None, 'T': True, 'F': False}
+    containers = {'l': list, 't': tuple, 'S': set}
+
+    def __init__(self, threshold=512, level=6, legacy=None):
+        self.threshold = threshold
+        self.level = level
+        self.legacy = legacy
+
+    def dumps(self, value):
+        chunks = []
+        self.encode(value, chunks.append)
+        body, flags = ''.join(chunks), 0
+
+        if self.threshold is not None and len(body) > self.threshold:
+            compressed = zlib.compress(body, self.level)
+            if len(compressed) < len(body):
+                body, flags = compressed, self.COMPRESSED
+
+        return chr(self.version) + chr(flags) + body
+
+    def loads(self, data):
+        if not data or ord(data[0]) != self.version:
+            if self.legacy is None:
+                raise ValueError("Unknown session data format")
+            return self.legacy.loads(data)
+
+        try:
+            body = data[2:]
+            if ord(data[1]) & self.COMPRESSED:
+                body = zlib.decompress(body)
+            value, position = self.decode(body, 0)
+        except (IndexError, KeyError, struct.error, zlib.error) as err:
+            raise ValueError("Malformed session data: {}".format(err))
+
+        if position != len(body):
+            raise ValueError("Malformed session data: trailing bytes")
+        return value
+
+    def encode(self, value, write):
+        if value is None:
+            write('N')
+        elif value is True:
+            write('T')
+        elif value is False:
+            write('F')
+        elif isinstance(value, (int, long)):
+            write('i')
+            write_varint(zigzag(value), write)
+        elif isinstance(value, float):
+            write('d')
+            write(DOUBLE.pack(value))
+        elif isinstance(value, str):
+            write('s')
+            write_varint(len(value), write)
+            write(value)
+        elif isinstance(value, (unicode, _LazyString)):
+            value = unicode(value).encode('utf-8')
+            write('u')
+            write_varint(len(value), write)
+            write(value)
+        elif isinstance(value, dict):
+            write('D')
+            write_varint(len(value), write)
+            for key, item in value.iteritems():
+                self.encode(key, write)
+                self.encode(item, write)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            if isinstance(value, tuple):
+                write('t')
+            elif isinstance(value, (set, frozenset)):
+                write('S')
+            else:
+                write('l')
+            write_varint(len(value), write)
+            for item in value:
+                self.encode(item, write)
+        elif isinstance(value, datetime) and value.tzinfo is None:
+            delta = value - EPOCH
+            write('z')
+            write_varint(zigzag((delta.days * 86400 + delta.seconds) *
+                                1000000 + delta.microseconds), write)
+        else:
+            raise TypeError("Can't store {!r} in the session".format(value))
+
+    def decode(self, data, position):
+        tag = data[position]
+        position += 1
+
+        if tag in self.constants:
+            return self.constants[tag], position
+        if tag == 'i':
+            number, position = read_varint(data, position)
+            return unzigzag(number), position
+        if tag == 'd':
+            end = position + DOUBLE.size
+            return DOUBLE.unpack(data[position:end])[0], end
+        if tag in ('s', 'u'):
+            length, position = read_varint(data, position)
+            end = position + length
+            if end > len(data):
+                raise IndexError("string out of data")
+            if tag == 'u':
+                return data[position:end].decode('utf-8'), end
+            return data[position:end], end
+        if tag == 'D':
+            count, position = read_varint(data, position)
+            value = {}
+            for _ in xrange(count):
+                key, position = self.decode(data, position)
+                value[key], position = self.decode(data, position)
+            return value, position
+        if tag in ('l', 't', 'S'):
+            count, position = read_varint(data, position)
+            items = []
+            for _ in xrange(count):
+                item, position = self.decode(data, position)
+                items.append(item)
+            return self.containers[tag](items), position
+        if tag == 'z':
+            number, position = read_varint(data, position)
+            delta = timedelta(microseconds=unzigzag(number))
+            return EPOCH + delta, position
+        raise KeyError("unknown tag {!r}".format(tag))
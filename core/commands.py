@@ -5,6 +5,8 @@ from flask.ext.s3 import create_all
 from flask.ext.script import Command, Option
 
 from flamaster.core.indexer import index
+from flamaster.core.reindex import Reindexer
+from flamaster.core.tailer import ChangeTailer
 from flamaster.extensions import db, es
 
 from pyelasticsearch import ElasticHttpNotFoundError
@@ -47,28 +49,78 @@ class UpdateS3(Command):
 #             nose.run(argv=['-xs', 'tests'])
 
 
+def report(message):
+    print message
+
+
 class IndexCommand(Command):
 
-    def run(self, drop_index=False):
+    def run(self, drop_index=False, resume=False, workers=4,
+            chunk_size=1000, keep_old=False):
         if drop_index:
             self.drop_indexes()
         else:
-            self.create_indexes()
+            self.create_indexes(resume, workers, chunk_size, keep_old)
 
     def drop_indexes(self):
+        if current_app.config.get('INDEX_EMBEDDED'):
+            for cls in index.registry:
+                index.backend(cls).clean()
+            return
         try:
             es.delete_index(current_app.config['INDEX_NAME'])
         except ElasticHttpNotFoundError as error:
             print error
 
-    def create_indexes(self):
-        index.reindex()
+    def create_indexes(self, resume, workers, chunk_size, keep_old):
+        if current_app.config.get('INDEX_EMBEDDED'):
+            for cls in index.registry:
+                index.backend(cls).rebuild(cls)
+                report("{} indexed".format(index.get_name(cls)))
+            return
+        reindexer = Reindexer(workers, chunk_size, keep_old, report=report)
+        reindexer.run(resume)
 
     def get_options(self):
         return (
             Option('--drop', action="store_true", dest='drop_index'),
+            Option('--resume', action="store_true", dest='resume'),
+            Option('--keep-old', action="store_true", dest='keep_old'),
+            Option('--workers', type=int, default=4, dest='workers'),
+            Option('--chunk-size', type=int, default=1000,
+                   dest='chunk_size'),
             # Option('--no-bpython',
             #     action="store_true",
             #     dest='no_bpython',
             #     default=not(self.use_bpython))
         )
+
+
+class IndexWorkerCommand(Command):
+    """ Brings queued document changes to the elasticsearch index
+    """
+
+    def run(self, batch_size, interval):
+        index.work(batch_size, interval)
+
+    def get_options(self):
+        return (
+            Option('--batch-size', type=int, default=500, dest='batch_size'),
+            Option('--interval', type=float, default=1.0, dest='interval'),
+        )
+
+
+class IndexTailCommand(Command):
+    """ Indexes changes of the registered collections read from the
+        change stream or oplog, runs instead of `IndexWorkerCommand` with
+        ``INDEX_CHANGES_TAILED`` setting enabled
+    """
+
+    def run(self, batch_size, interval):
+        ChangeTailer(batch_size, interval).run()
+
+    def get_options(self):
+        return (
+            Option('--batch-size', type=int, default=500, dest='batch_size'),
+            Option('--interval', type=float, default=1.0, dest='interval'),
+        )
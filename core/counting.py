@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+
+from flamaster.extensions import redis
+
+from .cache import get_versions, storage_name
+
+
+__all__ = ['ExactCount', 'CachedCount', 'EstimatedCount']
+
+
+class ExactCount(object):
+    """ Default counting strategy, asks the storage for the exact amount of
+        objects matching the query on every call
+    """
+    name = 'exact'
+
+    def count(self, resource, objects):
+        """ Returns a pair of the objects amount and the name of the
+            strategy the amount was calculated with
+        """
+        return objects.count(), self.name
+
+
+class CachedCount(ExactCount):
+    """ Keeps exact counts in redis per model and filters set. Cached values
+        expire after `timeout` seconds or as soon as any object of the model
+        is saved or removed
+    """
+    name = 'cached'
+    prefix = 'count:'
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+
+    def get_key(self, resource, objects):
+        tag = storage_name(resource.model)
+        version, = get_versions(tag)
+        signature = hashlib.md5(resource.query_signature(objects)).hexdigest()
+        return "{}{}:{}:{}".format(self.prefix, tag, version, signature)
+
+    def count(self, resource, objects):
+        key = self.get_key(resource, objects)
+        count = redis.get(key)
+
+        if count is None:
+            count, _ = super(CachedCount, self).count(resource, objects)
+            redis.setex(key, self.timeout, count)
+
+        return int(count), self.name
+
+
+class EstimatedCount(ExactCount):
+    """ Takes the amount from the storage statistics for unfiltered object
+        sets and counts with the `fallback` strategy otherwise
+    """
+    name = 'estimated'
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or ExactCount()
+
+    def count(self, resource, objects):
+        estimate = resource.estimate_count(objects)
+
+        if estimate is None:
+            return self.fallback.count(resource, objects)
+        return estimate, self.name
@@ -14,16 +14,18 @@ from flamaster.core.models import CRUDMixin
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from . import http
-from .utils import jsonify_status_code, plural_underscored
+from .cache import translation_cache
+from .utils import jsonify_status_code, plural_underscored, set_http_cache
 
 
-def api_resource(bp, endpoint, pk_def):
+def api_resource(bp, endpoint, pk_def, http_cache=None):
     pk = pk_def.keys()[0]
     pk_type = pk_def[pk] and pk_def[pk].__name__ or None
     # building url from the endpoint
     url = "/{}/".format(endpoint)
     collection_methods = ['GET', 'POST']
     item_methods = ['GET', 'PUT', 'DELETE']
+    set_http_cache("{}.{}".format(bp.name, endpoint), http_cache)
 
     def wrapper(resource_class):
         resource = resource_class().as_view(endpoint)
@@ -39,33 +41,93 @@ def api_resource(bp, endpoint, pk_def):
     return wrapper
 
 
-def multilingual(cls):
-
+def current_language():
+    """ Language of the current request, the default one outside of it
+    """
     locale = get_locale()
     if locale is None:
-        lang = unicode(settings.BABEL_DEFAULT_LOCALE)
-    else:
-        lang = unicode(locale.language)
+        return unicode(settings.BABEL_DEFAULT_LOCALE)
+    return unicode(locale.language)
+
+
+def multilingual(cls):
+
+    def translations(self):
+        """ Localized values of the instance by locales, values are kept on
+            the instance once loaded
+        """
+        if self.__dict__.get('_translations') is None:
+            self._translations = {}
+        return self._translations
+
+    def get_translation(self):
+        lang = current_language()
+        if lang not in translations(self):
+            load_translations(self.__class__, [self])
+        # unsaved instance has no translations yet
+        return translations(self).get(lang, {})
+
+    def load_translations(cls, instances):
+        """ Loads localized values for all the `instances` at once. Values
+            are read from the translation cache, rows missing there are
+            fetched with the single query, so localized properties don't
+            query them one by one
+        """
+        lang = current_language()
+        instances = [i for i in instances
+                     if i.id is not None and lang not in translations(i)]
+        if not instances:
+            return
+
+        ids = [i.id for i in instances]
+        values = translation_cache.get_many(cls, ids, lang)
+        missing = [id for id in ids if id not in values]
+
+        if missing:
+            localized = cls.__localized__
+            rows = localized.query.filter(localized.parent_id.in_(missing),
+                                          localized.locale == lang)
+            loaded = dict((id, {}) for id in missing)
+            for row in rows:
+                loaded[row.parent_id] = dict(
+                    (field, getattr(row, field))
+                    for field in cls.__localized_fields__)
+
+            translation_cache.set_many(cls, loaded, lang)
+            values.update(loaded)
+
+        for instance in instances:
+            translations(instance)[lang] = values[instance.id]
+
+    def join_localized(cls, query):
+        """ Joins localized rows to the `query` of the model, so it could be
+            filtered or ordered by the `cls.__localized__` columns
+        """
+        localized = cls.__localized__
+        return query.outerjoin(localized, db.and_(
+            localized.parent_id == cls.id,
+            localized.locale == current_language()))
 
     def create_property(cls, localized, columns, field):
 
         def getter(self):
-            instance = localized.query.filter_by(id=self.id,
-                                                 locale=lang).first()
-            return instance and getattr(instance, field) or None
+            return get_translation(self).get(field) or None
 
         def setter(self, value):
-            from_db = localized.query.filter_by(id=self.id,
-                                                locale=lang).first()
-
-            instance = from_db or localized(parent=self, locale=lang)
+            lang = current_language()
+            instance = localized.query.filter_by(parent_id=self.id,
+                                                 locale=lang).first() or \
+                localized(parent=self, locale=lang)
             setattr(instance, field, value)
             instance.save()
 
+            translations(self).pop(lang, None)
+            translation_cache.delete(self.__class__, self.id, lang)
+
         def expression(self):
             return db.Query(columns[field]) \
                 .filter(localized.parent_id == self.id,
-                        localized.locale == lang).as_scalar()
+                        localized.locale == current_language()).as_scalar()
 
         setattr(cls, field, hybrid_property(getter, setter, expr=expression))
 
@@ -88,10 +150,15 @@ def multilingual(cls):
                                                  onupdate="CASCADE"),
                                    nullable=True),
             'parent': db.relationship(cls, backref='localized_ref'),
-            'locale': db.Column(db.Unicode(255), default=lang, index=True)
+            'locale': db.Column(db.Unicode(255), default=current_language,
+                                index=True)
         })
 
         cls_localized = type(class_name, (db.Model, CRUDMixin), columns)
+        cls.__localized__ = cls_localized
+        cls.__localized_fields__ = tuple(localized_names)
+        cls.load_translations = classmethod(load_translations)
+        cls.join_localized = classmethod(join_localized)
 
         for field in localized_names:
             create_property(cls, cls_localized, columns, field)
@@ -8,31 +8,34 @@ from flamaster.extensions import mail, mongo
 from mongoengine import StringField, ListField, EmailField, FileField
 
 from .decorators import classproperty
+from .serializers import get_serializer
 from .utils import plural_underscored
 
 
 class BaseMixin(object):
 
-    def as_dict(self, include=None, exclude=['password']):
-        """ method for building dictionary for model value-properties filled
-            with data from mapped storage backend
-        """
-        document_fields = self._fields.keys()
+    # never exported by `as_dict`
+    hidden_fields = ['_ns', '_int_id', '_class']
 
-        exportable_fields = (include or []) + document_fields
-
-        exclude = ['_ns', '_int_id', '_class'] + (exclude or [])
+    @classmethod
+    def exportable_fields(cls):
+        return cls._fields.keys()
 
-        exportable_fields = set(exportable_fields) - set(exclude)
+    @classmethod
+    def serializable_fields(cls):
+        """ Names of the fields `as_dict` outputs by default
+        """
+        return set(cls.exportable_fields()) - \
+            set(cls.hidden_fields + ['password'])
 
-        # convert undescored fields:
-        result = dict()
-        for field in exportable_fields:
-            value = getattr(self, field)
-            if hasattr(value, '__call__'):
-                value = value()
-            result[field] = value
-        return result
+    def as_dict(self, include=None, exclude=['password'], only=None):
+        """ method for building dictionary for model value-properties filled
+            with data from mapped storage backend, `only` restricts the
+            result to the listed fields
+        """
+        exclude = self.hidden_fields + (exclude or [])
+        serializer = get_serializer(self.__class__, include, exclude, only)
+        return serializer(self)
 
     @classmethod
     def create(cls, **kwargs):
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import RLock
+
+from flask import current_app
+
+from .indexer import BaseIndex
+from .utils import json_dumps
+
+
+__all__ = ['EmbeddedIndex']
+
+# posting arrays hold 32-bit document ordinals
+TYPECODE = array('I').itemsize == 4 and 'I' or 'L'
+ITEMSIZE = array(TYPECODE).itemsize
+
+MAGIC = 'FLIX\x01'
+# magic and the length of the json header following it
+PREAMBLE = struct.Struct('<5sI')
+
+TERMS = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TERMS.findall(unicode(text).lower())
+
+
+def distance(a, b, limit):
+    """ Levenshtein distance of the strings, or `limit` + 1 as soon as it
+        is known to exceed the `limit`
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = range(len(b) + 1)
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class EmbeddedIndex(BaseIndex):
+    """ Search index kept in the memory of the process, for installations
+        without elasticsearch. Text of the string fields, and of every
+        locale of the multilingual ones, is split into terms mapped to the
+        sorted arrays of document ordinals. Updated document gets the new
+        ordinal, so postings stay sorted by appending, and the old one is
+        left dead until the index is compacted.
+
+        The index is saved to the snapshot file by the process writing to
+        it, the indexing worker, and other processes load the snapshot with
+        mmap when it changes. Postings are read from the mapped file on the
+        first use only. Documents are serialized by the `source` index,
+        which is registered for their class, and `search` answers the
+        subset of the elasticsearch query DSL and aggregations used by the
+        resources
+    """
+    # terms of this length and longer are completed by prefix
+    prefix_length = 2
+    # terms of this length and longer match misspelled ones
+    fuzzy_length = 4
+    max_expansions = 50
+    prefix_weight = 0.5
+    fuzzy_weight = 0.3
+
+    def __init__(self, source):
+        self.source = source
+        self.index_type = source.index_type
+        super(EmbeddedIndex, self).__init__()
+        self._lock = RLock()
+        self._stamp = None
+        self._mmap = None
+        self._reset()
+
+    def _reset(self):
+        # ordinal -> document id and source, None for the dead ones
+        self._ids, self._sources = [], []
+        self._ordinals = {}
+        # field key, e.g. `name.de` -> term -> posting array, or the
+        # (position, count) of the posting in the mapped snapshot
+        self._postings = defaultdict(dict)
+        # field key -> sorted terms for the prefix lookups
+        self._terms = {}
+        self._swap = False
+
+    @property
+    def path(self):
+        root = current_app.config.get('INDEX_EMBEDDED_PATH')
+        if root is None:
+            root = os.path.join(current_app.instance_path, 'index')
+        return os.path.join(root, "{}.idx".format(self.index_type))
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    # -- writing --
+
+    def get_data(self, cls):
+        return self.source.get_data(cls)
+
+    def create(self, cls, document=None, in_bulk=False):
+        documents = in_bulk and (document or self.get_data(cls)) or \
+            [document]
+        with self._lock:
+            self.refresh()
+            for document in documents:
+                self._add(self.source.serialize(document))
+            self.save()
+
+    def update(self, cls, document=None, in_bulk=False):
+        return self.create(cls, document, in_bulk)
+
+    def delete(self, cls, document):
+        with self._lock:
+            self.refresh()
+            self._remove(str(document.id))
+            self.save()
+
+    def sync(self, cls, ids, fields=None):
+        # documents are indexed completely, it's as cheap as the update
+        documents = list(self.get_data(cls).filter(id__in=list(ids)))
+        with self._lock:
+            self.refresh()
+            for document in documents:
+                self._add(self.source.serialize(document))
+            for id in set(ids) - set(str(d.id) for d in documents):
+                self._remove(id)
+            self.save()
+
+    def clean(self):
+        with self._lock:
+            self._reset()
+            self.save()
+
+    def rebuild(self, cls):
+        with self._lock:
+            self._reset()
+            for document in self.get_data(cls):
+                self._add(self.source.serialize(document))
+            self.save()
+
+    def _add(self, iobject):
+        # sources are kept as they would be loaded from the snapshot
+        iobject = json.loads(json_dumps(iobject))
+        id = str(iobject['id'])
+        self._remove(id)
+
+        ordinal = len(self._ids)
+        self._ids.append(id)
+        self._sources.append(iobject)
+        self._ordinals[id] = ordinal
+
+        for key, text in self.texts(iobject):
+            for term in set(tokenize(text)):
+                self._posting(key, term, create=True).append(ordinal)
+
+    def _remove(self, id):
+        ordinal = self._ordinals.pop(id, None)
+        if ordinal is not None:
+            self._ids[ordinal] = self._sources[ordinal] = None
+
+        dead = len(self._ids) - len(self._ordinals)
+        if dead > 1000 and dead > len(self._ordinals):
+            self._compact()
+
+    def _compact(self):
+        """ Reindexes the live documents, dropping the dead ordinals
+        """
+        sources = filter(None, self._sources)
+        self._reset()
+        for iobject in sources:
+            self._add(iobject)
+
+    def texts(self, iobject):
+        """ Pairs of the field key and the text indexed under it, locales
+            of the multilingual fields are indexed separately
+        """
+        for name, value in iobject.iteritems():
+            if name == 'id':
+                continue
+            if isinstance(value, basestring):
+                yield name, value
+            elif isinstance(value, dict):
+                for locale, text in value.iteritems():
+                    if isinstance(text, basestring):
+                        yield "{}.{}".format(name, locale), text
+
+    def _posting(self, key, term, create=False):
+        terms = self._postings.get(key, {})
+        posting = terms.get(term)
+
+        if posting is None:
+            if not create:
+                return None
+            posting = self._postings[key][term] = array(TYPECODE)
+            if key in self._terms:
+                insort(self._terms[key], term)
+        elif isinstance(posting, tuple):
+            # first use of the posting loaded from the snapshot
+            position, count = posting
+            posting = array(TYPECODE)
+            posting.fromstring(self._mmap[position:position +
+                                          count * ITEMSIZE])
+            if self._swap:
+                posting.byteswap()
+            terms[term] = posting
+        return posting
+
+    # -- snapshots --
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    def save(self):
+        """ Writes the snapshot next to the current one and renames it, so
+            readers never see the partially written file
+        """
+        path = self.path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        table, chunks, offset = [], [], 0
+        for key, terms in self._postings.iteritems():
+            for term in terms.keys():
+                posting = self._posting(key, term)
+                table.append([key, term, offset, len(posting)])
+                chunks.append(posting.tostring())
+                offset += len(posting)
+
+        header = json_dumps({'ids': self._ids, 'sources': self._sources,
+                             'postings': table, 'byteorder': sys.byteorder})
+        temporary = "{}.{}".format(path, os.getpid())
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(PREAMBLE.pack(MAGIC, len(header)))
+            snapshot.write(header)
+            for chunk in chunks:
+                snapshot.write(chunk)
+        os.rename(temporary, path)
+        self._stamp = self._stat()
+
+    def load(self):
+        with open(self.path, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, length = PREAMBLE.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError("{} is not the index snapshot".format(self.path))
+        header = json.loads(mapped[PREAMBLE.size:PREAMBLE.size + length])
+        start = PREAMBLE.size + length
+
+        previous = self._mmap
+        self._reset()
+        self._mmap = mapped
+        self._swap = header['byteorder'] != sys.byteorder
+        self._ids, self._sources = header['ids'], header['sources']
+        self._ordinals = dict((id, ordinal)
+                              for ordinal, id in enumerate(self._ids)
+                              if id is not None)
+        for key, term, offset, count in header['postings']:
+            self._postings[key][term] = (start + offset * ITEMSIZE, count)
+
+        if previous is not None:
+            previous.close()
+
+    def refresh(self):
+        """ Loads the snapshot if it has been changed by another process
+        """
+        with self._lock:
+            stamp = self._stat()
+            if stamp is not None and stamp != self._stamp:
+                self.load()
+                self._stamp = stamp
+
+    # -- searching --
+
+    def search(self, query):
+        started = time.time()
+        with self._lock:
+            self.refresh()
+            scores = self._query(query.get('query', {'match_all': {}}))
+            ranked = sorted(scores.iteritems(),
+                            key=lambda item: (-item[1], item[0]))
+            offset = query.get('from', 0)
+            page = ranked[offset:offset + query.get('size', 10)]
+            hits = [{'_id': self._ids[ordinal], '_type': self.index_type,
+                     '_score': score, '_source': self._sources[ordinal]}
+                    for ordinal, score in page]
+            aggs = query.get('aggs', query.get('aggregations'))
+            if aggs is not None:
+                aggs = dict((name, self._aggregate(spec, scores))
+                            for name, spec in aggs.iteritems())
+
+        result = {
+            'took': int((time.time() - started) * 1000),
+            'hits': {
+                'total': len(ranked),
+                'max_score': ranked and ranked[0][1] or None,
+                'hits': hits,
+            },
+        }
+        if aggs is not None:
+            result['aggregations'] = aggs
+        return result
+
+    def _query(self, clause):
+        """ Scores of the documents matching the query clause by ordinals
+        """
+        (kind, spec), = clause.items()
+
+        if kind == 'match_all':
+            return dict.fromkeys(self._ordinals.itervalues(), 1.0)
+        if kind == 'match':
+            (field, text), = spec.items()
+            if isinstance(text, dict):
+                text = text['query']
+            return self._match(text, [field])
+        if kind == 'multi_match':
+            return self._match(spec['query'], spec.get('fields', ['*']))
+        if kind == 'bool':
+            return self._bool(spec)
+        if kind in ('term', 'terms', 'range', 'exists'):
+            return self._bool({'filter': clause})
+        raise ValueError("Unsupported query: {}".format(kind))
+
+    def _bool(self, spec):
+        musts = self._clauses(spec.get('must'))
+        if musts:
+            scores = self._query(musts[0])
+            for clause in musts[1:]:
+                other = self._query(clause)
+                scores = dict((ordinal, score + other[ordinal])
+                              for ordinal, score in scores.iteritems()
+                              if ordinal in other)
+        else:
+            scores = dict.fromkeys(self._ordinals.itervalues(), 0.0)
+
+        shoulds = self._clauses(spec.get('should'))
+        if shoulds:
+            matched = set()
+            for clause in shoulds:
+                for ordinal, score in self._query(clause).iteritems():
+                    if ordinal in scores:
+                        scores[ordinal] += score
+                        matched.add(ordinal)
+            if not musts:
+                scores = dict((ordinal, scores[ordinal])
+                              for ordinal in matched)
+
+        filters = self._clauses(spec.get('filter'))
+        excluded = self._clauses(spec.get('must_not'))
+        return dict((ordinal, score) for ordinal, score in scores.iteritems()
+                    if self._passes(self._sources[ordinal], filters,
+                                    excluded))
+
+    def _clauses(self, clauses):
+        if clauses is None:
+            return []
+        if isinstance(clauses, dict):
+            return [clauses]
+        return list(clauses)
+
+    def _passes(self, iobject, filters, excluded=()):
+        return (all(self._check(iobject, f) for f in filters) and
+                not any(self._check(iobject, f) for f in excluded))
+
+    def _check(self, iobject, clause):
+        (kind, spec), = clause.items()
+
+        if kind == 'bool':
+            shoulds = self._clauses(spec.get('should'))
+            return (self._passes(iobject,
+                                 self._clauses(spec.get('must')) +
+                                 self._clauses(spec.get('filter')),
+                                 self._clauses(spec.get('must_not'))) and
+                    (not shoulds or
+                     any(self._check(iobject, s) for s in shoulds)))
+        if kind == 'exists':
+            return self._value(iobject, spec['field']) is not None
+        if kind == 'match_all':
+            return True
+
+        (field, expected), = spec.items()
+        value = self._value(iobject, field)
+        values = isinstance(value, list) and value or [value]
+
+        if kind == 'term':
+            return expected in values
+        if kind == 'terms':
+            return any(v in expected for v in values)
+        if kind == 'range':
+            bounds = {'gt': lambda v, b: v > b, 'gte': lambda v, b: v >= b,
+                      'lt': lambda v, b: v < b, 'lte': lambda v, b: v <= b}
+            return any(v is not None and
+                       all(bounds[op](v, bound)
+                           for op, bound in expected.iteritems()
+                           if op in bounds)
+                       for v in values)
+        raise ValueError("Unsupported filter: {}".format(kind))
+
+    def _aggregate(self, spec, ordinals):
+        """ Result of the aggregation over the matched documents, only the
+            `filters`, `histogram`, `min` and `max` ones without
+            sub-aggregations are supported
+        """
+        if len(spec) != 1:
+            raise ValueError("Unsupported aggregation: {}".format(spec))
+        (kind, params), = spec.items()
+
+        if kind == 'filters':
+            def bucket(clause):
+                return {'doc_count': sum(
+                    1 for ordinal in ordinals
+                    if self._check(self._sources[ordinal], clause))}
+
+            filters = params['filters']
+            if isinstance(filters, dict):
+                return {'buckets': dict((key, bucket(clause))
+                                        for key, clause in filters.items())}
+            return {'buckets': map(bucket, filters)}
+
+        if kind == 'histogram':
+            interval = params['interval']
+            counts = defaultdict(set)
+            for ordinal, value in self._numbers(ordinals, params['field']):
+                counts[int(math.floor(value / interval))].add(ordinal)
+            min_doc_count = params.get('min_doc_count', 0)
+            # empty buckets between the filled ones are listed as well
+            steps = counts and xrange(min(counts), max(counts) + 1) or ()
+            return {'buckets': [
+                {'key': step * interval, 'doc_count': len(counts[step])}
+                for step in steps if len(counts[step]) >= min_doc_count]}
+
+        if kind in ('min', 'max'):
+            values = [value for _, value in
+                      self._numbers(ordinals, params['field'])]
+            if not values:
+                return {'value': None}
+            aggregate = kind == 'min' and min or max
+            return {'value': aggregate(values)}
+
+        raise ValueError("Unsupported aggregation: {}".format(kind))
+
+    def _numbers(self, ordinals, field):
+        """ Pairs of the ordinal and the value of the field, for every value
+            of the list ones
+        """
+        for ordinal in ordinals:
+            value = self._value(self._sources[ordinal], field)
+            for item in isinstance(value, list) and value or [value]:
+                if item is not None:
+                    yield ordinal, item
+
+    def _value(self, iobject, field):
+        value = iobject
+        for name in field.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(name)
+        return value
+
+    def _match(self, text, fields):
+        """ Documents having any of the text terms, scored by the term
+            rarity, field boost and whether the term is matched exactly, by
+            prefix or with a typo
+        """
+        scores, live = defaultdict(float), float(len(self._ordinals) or 1)
+        for spec in fields:
+            field, _, boost = spec.partition('^')
+            boost = boost and float(boost) or 1.0
+            for key in self._keys(field):
+                for token in tokenize(text):
+                    for term, weight in self._expand(key, token):
+                        posting = self._posting(key, term)
+                        rarity = math.log(1 + live / len(posting))
+                        for ordinal in posting:
+                            if self._ids[ordinal] is not None:
+                                scores[ordinal] += boost * weight * rarity
+        return scores
+
+    def _keys(self, field):
+        """ Field keys of the field: every locale of the multilingual one
+        """
+        if field in ('*', '_all'):
+            return self._postings.keys()
+        prefix = field + '.'
+        return [key for key in self._postings
+                if key == field or key.startswith(prefix)]
+
+    def _sorted_terms(self, key):
+        if key not in self._terms:
+            self._terms[key] = sorted(self._postings.get(key, ()))
+        return self._terms[key]
+
+    def _expand(self, key, token):
+        """ Terms of the field matching the token with their weights
+        """
+        terms = self._postings.get(key, {})
+        if token in terms:
+            yield token, 1.0
+
+        if len(token) >= self.prefix_length:
+            ordered = self._sorted_terms(key)
+            position = bisect_left(ordered, token)
+            for term in ordered[position:position + self.max_expansions]:
+                if not term.startswith(token):
+                    break
+                if term != token:
+                    yield term, self.prefix_weight
+
+        if token not in terms and len(token) >= self.fuzzy_length:
+            limit = len(token) < 8 and 1 or 2
+            expanded = 0
+            for term in self._sorted_terms(key):
+                if (not term.startswith(token) and
+                        distance(token, term, limit) <= limit):
+                    yield term, self.fuzzy_weight
+                    expanded += 1
+                    if expanded >= self.max_expansions:
+                        break
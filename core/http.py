@@ -3,6 +3,8 @@ CREATED = 201
 ACCEPTED = 202
 NO_CONTENT = 204
 
+NOT_MODIFIED = 304
+
 BAD_REQUEST = 400
 UNAUTHORIZED = 401
 FORBIDDEN = 403
@@ -11,3 +13,4 @@ METHOD_NOT_ALLOWED = 405
 CONFLICT = 409
 
 INTERNAL_ERR = 500
+SERVICE_UNAVAILABLE = 503
@@ -1,28 +1,146 @@
 import logging
-from itertools import imap
+import time
+from collections import defaultdict
 from flask import current_app
 from mongoengine import signals
-from operator import methodcaller
-from requests.exceptions import ConnectionError
+from pyelasticsearch import ElasticHttpNotFoundError
+from requests.exceptions import ConnectionError, Timeout
 
-from flamaster.core.utils import CustomEncoder
-from flamaster.extensions import es
+from flamaster.core.breaker import CircuitBreaker, GuardedClient
+from flamaster.core.utils import CustomEncoder, by_languages
+from flamaster.extensions import es, redis
 
 
 logger = logging.getLogger('indexer')
 
+# elasticsearch calls fail fast while the node is unreachable, changes stay
+# queued meanwhile and are indexed once a probe call succeeds
+breaker = CircuitBreaker()
+search_engine = GuardedClient(es, breaker)
+
+# redis hash describing the reindex in progress, see `core.reindex`
+REINDEX_KEY = 'reindex'
+
+
+@signals.pre_save.connect
+def remember_changes(cls, document, **kwargs):
+    # changed fields are cleared by the time `post_save` is sent
+    document._index_changes = list(document._changed_fields)
+
 
 @signals.post_save.connect
 def put_on_index(cls, document, created):
     if created:
         index.process(cls, document, action=Index.CREATE)
     else:
-        index.process(cls, document, action=Index.UPDATE)
+        changes = getattr(document, '_index_changes', None)
+        index.process(cls, document, action=Index.UPDATE, changes=changes)
 
 
 @signals.post_bulk_insert.connect
 def put_all_on_index(cls, documents, loaded):
-    index.process(cls, documents, in_bulk=True)
+    index.process(cls, documents, action=Index.CREATE, in_bulk=True)
+
+
+@signals.post_delete.connect
+def remove_from_index(cls, document):
+    index.process(cls, document, action=Index.DELETE)
+
+
+class IndexQueue(object):
+    """ Set of documents waiting for indexing, kept in redis. Documents are
+        queued by their class and id only and the worker indexes the state
+        they have at the moment of processing, so repeated changes of the
+        same document are coalesced into the single operation. Names of
+        the changed fields are collected per document as well, so the worker
+        could update just them
+    """
+    key = 'index:queue'
+    fields_prefix = 'index:fields:'
+    # marks documents which should be indexed completely
+    ALL = '*'
+    # fields of documents lost from the queue are dropped eventually
+    fields_timeout = 86400
+    # failed indexing attempts by keys, and keys given up after
+    # `max_retries` of them, left for the inspection
+    retries_key = 'index:retries'
+    failed_key = 'index:failed'
+    max_retries = 5
+
+    def push(self, keys, fields=None):
+        keys = list(keys)
+        if not keys:
+            return
+
+        pipe = redis.pipeline(transaction=False)
+        # fields go first, the worker reads them after popping the key
+        for key in keys:
+            pipe.sadd(self.fields_prefix + key, *(fields or [self.ALL]))
+            pipe.expire(self.fields_prefix + key, self.fields_timeout)
+        pipe.sadd(self.key, *keys)
+        pipe.execute()
+
+    def pop(self, count):
+        """ Returns dictionary of the changed fields by popped keys, fields
+            are None for the documents to be indexed completely
+        """
+        pipe = redis.pipeline(transaction=False)
+        for _ in xrange(count):
+            pipe.spop(self.key)
+        keys = [key for key in pipe.execute() if key is not None]
+
+        for key in keys:
+            pipe.smembers(self.fields_prefix + key)
+            pipe.delete(self.fields_prefix + key)
+        results = pipe.execute()[::2]
+
+        popped = {}
+        for key, fields in zip(keys, results):
+            if not fields or self.ALL in fields:
+                fields = None
+            popped[key] = fields
+        return popped
+
+    def restore(self, popped):
+        """ Queues the keys popped by `pop` again with their fields
+        """
+        if not popped:
+            return
+
+        pipe = redis.pipeline(transaction=False)
+        for key, fields in popped.iteritems():
+            pipe.sadd(self.fields_prefix + key, *(fields or [self.ALL]))
+            pipe.expire(self.fields_prefix + key, self.fields_timeout)
+        pipe.sadd(self.key, *popped.keys())
+        pipe.execute()
+
+    def retry(self, popped):
+        """ Queues the keys of documents failed to be indexed again, keys
+            failed more than `max_retries` times in `fields_timeout` are
+            moved to the `failed_key` set instead of looping forever
+        """
+        if not popped:
+            return
+
+        keys = list(popped)
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hincrby(self.retries_key, key, 1)
+        pipe.expire(self.retries_key, self.fields_timeout)
+        attempts = pipe.execute()[:-1]
+
+        failed = [key for key, attempt in zip(keys, attempts)
+                  if attempt > self.max_retries]
+        if failed:
+            logger.error("Indexing of %s given up", ', '.join(failed))
+            pipe.hdel(self.retries_key, *failed)
+            pipe.sadd(self.failed_key, *failed)
+            pipe.execute()
+        self.restore(dict((key, popped[key]) for key in keys
+                          if key not in failed))
+
+    def __len__(self):
+        return redis.scard(self.key)
 
 
 class BaseIndex(object):
@@ -43,91 +161,315 @@ class BaseIndex(object):
     def update(self, cls, document=None):
         raise NotImplementedError()
 
+    def sync(self, cls, ids, fields=None):
+        """ Brings documents with passed ids to the index in their current
+            state, removes the ones which don't exist anymore. Only changed
+            fields are updated for documents listed in the `fields` mapping
+        """
+        raise NotImplementedError()
+
 
 class MongoDocumentIndex(BaseIndex):
 
+    @property
+    def index(self):
+        """ Alias of the live index
+        """
+        return current_app.config['INDEX_NAME']
+
+    def indices(self):
+        """ Indices changes are written to: the live one and the one being
+            rebuilt, if any, so it doesn't miss changes of copied documents
+        """
+        target = redis.hget(REINDEX_KEY, 'target')
+        return target and [self.index, target] or [self.index]
+
     def get_data(self, cls):
         return cls.objects
 
     def create(self, cls, document=None, in_bulk=False):
-        self.index = current_app.config['INDEX_NAME']
         if in_bulk:
             documents = document or self.get_data(cls)
-            iobjects = imap(lambda d: d.as_dict(), documents)
-            es.bulk_index(self.index, self.index_type, iobjects,
-                          refresh=True)
+            iobjects = (self.serialize(d) for d in documents)
+            search_engine.bulk_index(self.index, self.index_type, iobjects)
         else:
-            iobject = document.as_dict()
-            es.index(self.index, self.index_type, iobject, id=iobject['id'],
-                     refresh=True)
+            iobject = self.serialize(document)
+            search_engine.index(self.index, self.index_type, iobject,
+                                id=iobject['id'])
 
     def update(self, cls, document=None, in_bulk=False):
         return self.create(cls, document, in_bulk)
 
     def delete(self, cls, document):
-        es.delete(self.index, self.index_type, str(document.id), refresh=True)
+        self.delete_ids([str(document.id)])
+
+    def delete_ids(self, ids):
+        for name in self.indices():
+            for id in ids:
+                try:
+                    search_engine.delete(name, self.index_type, id)
+                except ElasticHttpNotFoundError:
+                    pass
+
+    def serialize(self, document):
+        """ Indexed representation of the document
+        """
+        return self.localize(document.as_dict())
+
+    def partial(self, document, fields):
+        """ Part of the indexed document with the changed `fields`, should
+            be extended if the index holds values computed from them
+        """
+        return self.localize(document.as_dict(only=fields))
+
+    def localize(self, iobject):
+        """ Replaces multilingual values with objects of their texts by
+            languages, so they are searched by fields like `name.en`
+        """
+        for name, value in iobject.items():
+            translations = getattr(value, 'translations', None)
+            if translations is not None:
+                iobject[name] = by_languages(translations)
+        return iobject
+
+    def sync(self, cls, ids, fields=None):
+        fields = fields or {}
+        documents = list(self.get_data(cls).filter(id__in=list(ids)))
+        complete = []
+
+        for document in documents:
+            changed = fields.get(str(document.id))
+            if changed is None or not self.update_fields(document, changed):
+                complete.append(document)
+
+        if complete:
+            iobjects = [self.serialize(d) for d in complete]
+            for name in self.indices():
+                search_engine.bulk_index(name, self.index_type, iobjects)
+
+        self.delete_ids(set(ids) - set(str(d.id) for d in documents))
+
+    # assigns the changed fields to the source as they are
+    assign_script = ('for (field in params.fields.entrySet()) '
+                     '{ ctx._source[field.getKey()] = field.getValue() }')
+
+    def update_fields(self, document, fields):
+        """ Sends the partial update of the document, returns False if the
+            document is not in the index yet. Partial documents are merged
+            into the indexed ones recursively, so objects, e.g. multilingual
+            values indexed by languages (see `localize`), are replaced by
+            the script instead, otherwise removed keys would stay in them
+        """
+        iobject = self.partial(document, fields)
+        if any(isinstance(value, dict) for value in iobject.itervalues()):
+            update = {'script': {'source': self.assign_script,
+                                 'lang': 'painless',
+                                 'params': {'fields': iobject}}}
+        else:
+            update = {'doc': iobject}
+
+        try:
+            for name in self.indices():
+                search_engine.update(name, self.index_type, str(document.id),
+                                     **update)
+        except ElasticHttpNotFoundError:
+            return False
+        return True
 
     def clean(self):
-        es.delete_all(self.index, self.index_type)
+        search_engine.delete_all(self.index, self.index_type)
 
     def search(self, query):
         # {'query': {'match': {'name': 'some place'}}}
-        return es.search(query, index=self.index, doc_type=self.index_type)
+        return search_engine.search(query, index=self.index,
+                                    doc_type=self.index_type)
 
 
 class Index(object):
+    """ Registry of indexed document classes. Changes of the documents are
+        queued in redis and brought to elasticsearch by the `work` loop, so
+        requests don't wait for the index. Search doesn't see changes until
+        the worker has processed them and the index has been refreshed
+        according to its ``refresh_interval``
+    """
 
     CREATE = 'create'
     UPDATE = 'update'
+    DELETE = 'delete'
 
     def __init__(self):
         self.registry = {}
+        self.names = {}
+        self.embedded = {}
+        self.queue = IndexQueue()
 
     def add(self, cls, index_cls):
         if cls not in self.registry:
             self.registry[cls] = index_cls()
+            self.names[self.get_name(cls)] = cls
         else:
             logger.info("Double registration for %s", cls)
 
     def remove(self, cls):
         if cls in self.registry:
             del self.registry[cls]
+            del self.names[self.get_name(cls)]
         else:
             raise Exception('Model not registered')
 
+    def resolve(self, cls):
+        """ Registered class documents of the `cls` are indexed with, so
+            subclasses of the registered document are indexed along with it
+        """
+        for klass in cls.__mro__:
+            if klass in self.registry:
+                return klass
+        return None
+
+    def backend(self, cls):
+        """ Index documents of the registered `cls` are written to and
+            searched in: the registered one, or its embedded counterpart if
+            ``INDEX_EMBEDDED`` is set
+        """
+        if not current_app.config.get('INDEX_EMBEDDED'):
+            return self.registry[cls]
+        if cls not in self.embedded:
+            from .embedded import EmbeddedIndex
+            self.embedded[cls] = EmbeddedIndex(self.registry[cls])
+        return self.embedded[cls]
+
+    def get_name(self, cls):
+        return "{}.{}".format(cls.__module__, cls.__name__)
+
+    def get_key(self, cls, id):
+        return "{}:{}".format(self.get_name(cls), id)
+
     def _patch_encoder(self):
         current_app.extensions['elasticsearch'].json_encoder = CustomEncoder
 
-    def process(self, cls, doc_or_docs, action, **kwargs):
-        """ Processing data changes on registered objects
+    def process(self, cls, doc_or_docs, action, in_bulk=False,
+                changes=None):
+        """ Queues data changes of registered objects for indexing
 
         :param cls: Indexed object class
-        :param doc_or_docs: Indexed object instance
-        :param action: Action to perform on index
-        :param kwargs: additional keyword args would be passed to `BaseIndex`
-                subclass
+        :param doc_or_docs: Indexed object instance or list of them
+        :param action: Action to perform on index, the worker decides
+                whether to index or remove the document from its state
+                when it is processed
+        :param in_bulk: Flag signalizing that list of objects is passed
+        :param changes: Changed fields of the updated document, as listed
+                in its `_changed_fields`
         """
-        self._patch_encoder()
-        index_cls = self.registry.get(cls)
-        if index_cls is not None:
-            applicator = methodcaller(action, cls, document=doc_or_docs,
-                                      **kwargs)
+        cls = self.resolve(cls)
+        if cls is None:
+            # current_app.logger.debug("Model %s not registered", cls)
+            return
+        if current_app.config.get('INDEX_CHANGES_TAILED'):
+            # `core.tailer` indexes every change of the collections
+            return
+
+        fields = None
+        if action == self.UPDATE and changes is not None:
+            fields = self.changed_fields(cls, changes)
+            if not fields:
+                # nothing indexed is changed
+                return
+
+        documents = in_bulk and doc_or_docs or [doc_or_docs]
+        self.queue.push((self.get_key(cls, d.id) for d in documents), fields)
+
+    def changed_fields(self, cls, changes):
+        """ Names of the top level fields for the changed db fields paths,
+            e.g. embedded documents are updated as a whole. Returns None if
+            any of them can't be resolved, document is indexed completely
+            then
+        """
+        fields = set()
+        for change in changes:
+            name = change.split('.', 1)[0]
+            name = cls._reverse_db_field_map.get(name, name)
+            if name not in cls._fields:
+                return None
+            fields.add(name)
+        return list(fields)
+
+    def flush(self, keys, requeue=True):
+        """ Indexes documents of the queued keys with the bulk request per
+            document class. `keys` could be the mapping of keys to the
+            changed fields returned by `IndexQueue.pop`. False is returned
+            if elasticsearch is unreachable, keys are queued again in this
+            case unless `requeue` is False. Documents failed for any other
+            reason are queued for the retry anyway, see `sync`
+        """
+        if not isinstance(keys, dict):
+            keys = dict.fromkeys(keys)
+
+        ids, fields, flushed = defaultdict(set), {}, True
+        for key, changed in keys.iteritems():
+            name, id = key.rsplit(':', 1)
+            if name in self.names:
+                ids[self.names[name]].add(id)
+                fields[id] = changed
+            else:
+                logger.warning("Model %s not registered", name)
+
+        for cls, cls_ids in ids.iteritems():
             try:
-                applicator(index_cls)
-            except ConnectionError as err:
+                self.sync(cls, cls_ids, fields)
+            except (ConnectionError, Timeout) as err:
                 logger.critical('ElasticSearch node unreachable, %s', err)
+                if requeue:
+                    self.queue.restore(dict(
+                        (self.get_key(cls, id), fields[id]) for id in cls_ids))
+                flushed = False
 
-        else:
-            pass
-            # current_app.logger.debug("Model %s not registered", cls)
+        return flushed
 
-    def reindex(self):
+    def sync(self, cls, ids, fields):
+        """ Syncs documents of the class, if it fails they are synced one
+            by one, so a single bad document doesn't hold back the others.
+            Failed documents are logged and queued for the retry
         """
-        Reindex all registered objects
+        backend = self.backend(cls)
+        try:
+            backend.sync(cls, ids, fields)
+            return
+        except (ConnectionError, Timeout):
+            raise
+        except Exception:
+            logger.exception("Indexing of %s failed", self.get_name(cls))
+
+        if len(ids) == 1:
+            failed = list(ids)
+        else:
+            failed = []
+            for id in ids:
+                try:
+                    backend.sync(cls, [id], fields)
+                except (ConnectionError, Timeout):
+                    raise
+                except Exception:
+                    logger.exception("Indexing of %s failed",
+                                     self.get_key(cls, id))
+                    failed.append(id)
+
+        self.queue.retry(dict((self.get_key(cls, id), fields[id])
+                              for id in failed))
+
+    def work(self, batch_size=500, interval=1.0):
+        """ Drains the queue by batches of up to `batch_size` documents.
+            Worker waits for `interval` seconds after incomplete batch, so
+            changes arriving meanwhile are accumulated and coalesced
         """
         self._patch_encoder()
-        for model_cls, index_cls in self.registry.iteritems():
-            index_cls.create(model_cls, in_bulk=True)
+        while True:
+            keys = self.queue.pop(batch_size)
+            if not self.flush(keys):
+                # keys are queued again, retrying after the pause
+                keys = []
+
+            if len(keys) < batch_size:
+                time.sleep(interval)
 
 
 index = Index()
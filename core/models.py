@@ -5,11 +5,15 @@ from datetime import datetime
 
 from flask.ext.sqlalchemy import orm
 
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 
 #  import class_mapper, object_mapper
 from flamaster.extensions import db
+from .serializers import get_serializer
+from .signals import model_changed
+from .tree import get_snapshot
 from .utils import slugify, plural_underscored
 
 
@@ -17,6 +21,28 @@ def raise_value(text):
     raise ValueError(text)
 
 
+def notify_changed(instance):
+    """ Sends `model_changed` for the instance once the transaction it is
+        changed in is committed, so caches invalidated by the signal are
+        never refilled with the data other connections can't see yet
+    """
+    session = db.session()
+    pending = session.__dict__.setdefault('_changed_instances', [])
+    if not any(instance is other for other in pending):
+        pending.append(instance)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def send_changes(session):
+    for instance in session.__dict__.pop('_changed_instances', ()):
+        model_changed.send(instance.__class__, instance=instance)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def drop_changes(session):
+    session.__dict__.pop('_changed_instances', None)
+
+
 class BaseMixin(object):
     """ Base mixin
     """
@@ -28,27 +54,26 @@ class BaseMixin(object):
         """
         return plural_underscored(cls.__name__)
 
-    def as_dict(self, include=None, exclude=None):
-        """ method for building dictionary for model value-properties filled
-            with data from mapped storage backend
-        """
-        column_properties = [p.key for p in self.__mapper__.iterate_properties
+    @classmethod
+    def exportable_fields(cls):
+        column_properties = [p.key for p in cls.__mapper__.iterate_properties
                                 if isinstance(p, orm.ColumnProperty)]
-        fields = [field.strip('_') for field in column_properties]
-
-        exportable_fields = (include or []) + fields
-        exportable_fields = set(exportable_fields) - set(exclude or [])
         # convert undescored fields:
+        return [field.strip('_') for field in column_properties]
 
-        result = dict()
-        for field in exportable_fields:
-            value = getattr(self, field)
-
-            if hasattr(value, '__call__'):
-                value = value()
-            result[field] = value
+    @classmethod
+    def serializable_fields(cls):
+        """ Names of the fields `as_dict` outputs by default
+        """
+        return set(cls.exportable_fields())
 
-        return result
+    def as_dict(self, include=None, exclude=None, only=None):
+        """ method for building dictionary for model value-properties filled
+            with data from mapped storage backend, `only` restricts the
+            result to the listed fields
+        """
+        serializer = get_serializer(self.__class__, include, exclude, only)
+        return serializer(self)
 
 
 class CRUDMixin(BaseMixin):
@@ -76,12 +101,14 @@ class CRUDMixin(BaseMixin):
 
     def save(self, commit=True):
         db.session.add(self)
+        notify_changed(self)
         if commit:
             db.session.commit()
         return self
 
     def delete(self, commit=True):
         db.session.delete(self)
+        notify_changed(self)
         if commit:
             db.session.commit()
 
@@ -161,22 +188,47 @@ class TreeNode(CRUDMixin):
         return db.relationship(cls.__name__, backref='children',
                                remote_side="{}.id".format(cls.__name__))
 
+    @classmethod
+    def snapshot(cls):
+        """ In-memory structure of all the trees of the model, see
+            `core.tree.TreeSnapshot`
+        """
+        return get_snapshot(cls)
+
     def delete(self, commit=True):
         """
         Overrided method to delete a whole tree/subtree of the node
         """
         instance = self.query.get(self.id)
         self.__class__.mp.delete_subtree(db.session, instance.id)
+        notify_changed(self)
         if commit:
             db.session.commit()
 
     def update(self, **kwargs):
-        """ Overrided update method from CRUDMixin
+        """ Overrided update method from CRUDMixin. Changing the parent
+            moves subtree of the node to the end of the new parent children,
+            paths of the subtree nodes are updated with the single query
         """
-        instance = self._setattrs(**kwargs).save(commit=True)
-        # rebuild Materialized Path tree structure
-        self.__class__.mp.drop_indices(db.session)
-        self.__class__.mp.rebuild_all_trees(db.session)
-        self.__class__.mp.create_indices(db.session)
-
-        return self.query.get(instance.id)
+        parent_id = self.parent_id
+        if 'parent' in kwargs:
+            parent = kwargs.pop('parent')
+            parent_id = parent and parent.id
+        parent_id = kwargs.pop('parent_id', parent_id)
+
+        if parent_id != self.parent_id:
+            self._move(parent_id)
+
+        return self._setattrs(**kwargs).save(commit=True)
+
+    def _move(self, parent_id):
+        mp = self.__class__.mp
+        # moving queries read the node from the database, not the session
+        db.session.flush()
+
+        if parent_id is None:
+            mp.detach_subtree(db.session, self.id)
+        else:
+            mp.move_subtree_to_bottom(db.session, self.id, parent_id)
+        # parent and path columns were changed bypassing the session
+        db.session.expire(self)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+from pyelasticsearch import ElasticHttpNotFoundError
+from pyelasticsearch.exceptions import BulkError
+
+from flamaster.extensions import es, redis
+
+from . import http
+from .indexer import REINDEX_KEY, index, logger, search_engine
+
+
+__all__ = ['Reindexer']
+
+
+class Reindexer(object):
+    """ Rebuilds the search index without downtime. Documents are copied to
+        the fresh index by `_id` ranges in the pool of threads, while the
+        search keeps using the old one through the ``INDEX_NAME`` alias.
+        The alias is switched to the new index once all ranges are copied.
+        Plan and copied ranges are kept in redis, so interrupted run can be
+        resumed
+    """
+    chunks_key = REINDEX_KEY + ':chunks'
+    done_key = REINDEX_KEY + ':done'
+    # separates class name and range bounds in chunk keys
+    separator = '|'
+
+    def __init__(self, workers=4, chunk_size=1000, keep_old=False,
+                 report=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.keep_old = keep_old
+        self.report = report or logger.info
+
+    @property
+    def alias(self):
+        return current_app.config['INDEX_NAME']
+
+    def run(self, resume=False):
+        index._patch_encoder()
+        target = resume and redis.hget(REINDEX_KEY, 'target') or None
+
+        if target is None:
+            target = self.start()
+        else:
+            self.report("Resuming reindex into {}".format(target))
+
+        done = redis.smembers(self.done_key)
+        chunks = [chunk for chunk in redis.lrange(self.chunks_key, 0, -1)
+                  if chunk not in done]
+        self.copy(target, chunks)
+        self.swap(target)
+        self.reset()
+
+    def start(self):
+        """ Creates the new index, with refreshes disabled until it's
+            filled, and plans the ranges to copy
+        """
+        self.reset()
+        target = "{}_{}".format(self.alias,
+                                datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        search_engine.create_index(target,
+                                   current_app.config.get('INDEX_SETTINGS'))
+        search_engine.update_settings(target,
+                                      {'index': {'refresh_interval': '-1'}})
+
+        chunks = list(self.plan())
+        pipe = redis.pipeline()
+        pipe.hset(REINDEX_KEY, 'target', target)
+        if chunks:
+            pipe.rpush(self.chunks_key, *chunks)
+        pipe.execute()
+
+        self.report("Reindexing into {}, {} chunks".format(target,
+                                                           len(chunks)))
+        return target
+
+    def reset(self):
+        redis.delete(REINDEX_KEY, self.chunks_key, self.done_key)
+
+    def plan(self):
+        """ Splits documents of every registered class into ranges of
+            `chunk_size` ids, range of the last chunk is open
+        """
+        for cls in index.registry:
+            name, start = index.get_name(cls), ''
+            while True:
+                objects = cls.objects.order_by('id')
+                if start:
+                    objects = objects.filter(id__gt=start)
+
+                end = objects.skip(self.chunk_size - 1).scalar('id').first()
+                end = end is not None and str(end) or ''
+                yield self.separator.join([name, start, end])
+
+                if not end:
+                    break
+                start = end
+
+    def copy_chunk(self, target, chunk):
+        name, start, end = chunk.split(self.separator)
+        cls = index.names[name]
+
+        objects = cls.objects.order_by('id')
+        if start:
+            objects = objects.filter(id__gt=start)
+        if end:
+            objects = objects.filter(id__lte=end)
+
+        cls_index = index.registry[cls]
+        # documents written by the workers since the plan was made are
+        # newer than the copied ones, they are kept
+        actions = [es.index_op(cls_index.serialize(document),
+                               id=str(document.id), overwrite_existing=False)
+                   for document in objects]
+        if actions:
+            try:
+                search_engine.bulk(actions, index=target,
+                                   doc_type=cls_index.index_type)
+            except BulkError as err:
+                if any(item.values()[0].get('status') != http.CONFLICT
+                       for item in err.errors):
+                    raise
+
+        redis.sadd(self.done_key, chunk)
+        return len(actions)
+
+    def copy(self, target, chunks):
+        app = current_app._get_current_object()
+
+        def copy_chunk(chunk):
+            with app.app_context():
+                return self.copy_chunk(target, chunk)
+
+        pool = ThreadPool(self.workers)
+        started, copied = time.time(), 0
+        try:
+            copying = pool.imap_unordered(copy_chunk, chunks)
+            for position, count in enumerate(copying, 1):
+                copied += count
+                rate = copied / max(time.time() - started, 0.001)
+                self.report("{}/{} chunks, {} documents, {:.1f} docs/sec"
+                            .format(position, len(chunks), copied, rate))
+        finally:
+            pool.close()
+            pool.join()
+
+    def aliased(self):
+        """ Names of the indices behind the alias. Index named as the alias
+            itself is the one created before the aliases were used
+        """
+        try:
+            return search_engine.send_request('GET',
+                                              [self.alias, '_alias']).keys()
+        except ElasticHttpNotFoundError:
+            return []
+
+    def swap(self, target):
+        search_engine.update_settings(target,
+                                      {'index': {'refresh_interval': '1s'}})
+        search_engine.refresh(target)
+
+        alias, old = self.alias, self.aliased()
+        actions = [{'remove': {'index': name, 'alias': alias}}
+                   for name in old if name not in (alias, target)]
+        if alias in old:
+            # alias can't be added while the index with its name exists, it
+            # is removed by the same request, so there is no moment writes
+            # could create the index with that name again
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': target, 'alias': alias}})
+        search_engine.update_aliases({'actions': actions})
+        self.report("{} points to {}".format(alias, target))
+
+        if not self.keep_old:
+            for name in old:
+                if name not in (alias, target):
+                    search_engine.delete_index(name)
@@ -1,17 +1,29 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
+import hashlib
 from datetime import datetime
+from functools import wraps
 import trafaret as t
 
-from flask import abort, request, current_app, g
+from flask import (abort, request, current_app, g, json, session,
+                   stream_with_context)
+from flask.ext.babel import get_locale
+from flask.ext.sqlalchemy import get_debug_queries
+from flask.ext.security import current_user
 from flask.views import MethodView
 
+from mongoengine import Q
 from mongoengine.base import ValidationError
+from sqlalchemy import func, text, tuple_
+from sqlalchemy.orm import ColumnProperty, load_only
 
 from . import http
 from flamaster.core.decorators import method_wrapper
 from flamaster.extensions import db
-from .utils import jsonify_status_code
+from .cache import get_versions, model_tags, response_cache
+from .counting import ExactCount
+from .utils import (jsonify_status_code, encode_cursor, decode_cursor,
+                    json_dumps, get_http_cache, CustomEncoder)
 
 
 class Resource(MethodView):
@@ -20,6 +32,27 @@ class Resource(MethodView):
     filters_map = t.Dict().make_optional('*').ignore_extra('*')
     filters_map_default = True
     page_size = 20
+    # strategy to calculate total amount of objects for the list responses
+    count_strategy = ExactCount()
+    count_method = None
+    # name of the attribute to order by for keyset pagination, list
+    # responses are paged with the opaque ``after`` cursor once it is set
+    cursor_key = None
+    after = None
+    # names requested with the ``fields`` argument to restrict serialization
+    fields = None
+    # list responses are encoded and sent by chunks of objects if set
+    streaming = False
+    stream_chunk_size = 100
+    # seconds successful responses are cached for per method, e.g.
+    # {'get': 300}, and additional tags to invalidate them with
+    cache_policy = None
+    cache_tags = ()
+    # GET responses are tagged with ETag to answer conditional requests,
+    # lists are versioned with latest value of the `etag_column` and the
+    # objects amount if it is set, instead of hashing the encoded body
+    conditional = True
+    etag_column = None
 
     def dispatch_request(self, *args, **kwargs):
         """ Overriding MethodView dispatch call to decorate every
@@ -36,6 +69,13 @@ class Resource(MethodView):
         """
         method = super(Resource, self).dispatch_request
 
+        timeout = (self.cache_policy or {}).get(request.method.lower())
+        if timeout:
+            method = self._cached(method, timeout)
+
+        if self.conditional and request.method == 'GET':
+            method = self._conditional(method)
+
         if self.method_decorators is None:
             return method(*args, **kwargs)
 
@@ -52,6 +92,104 @@ class Resource(MethodView):
 
         return method(*args, **kwargs)
 
+    def get_cache_tags(self):
+        tags = list(self.cache_tags)
+        if getattr(self, 'model', None) is not None:
+            tags.extend(model_tags(self.model))
+        return tags
+
+    def get_cache_key(self, **kwargs):
+        """ Cached responses are distinguished by endpoint, arguments,
+            locale and roles of the current user. Versions of the cache tags
+            make keys stale as soon as related models change
+        """
+        if current_user.is_anonymous():
+            roles = []
+        else:
+            roles = sorted(role.name for role in current_user.roles)
+
+        tags = sorted(self.get_cache_tags())
+        key = [request.endpoint, request.method, sorted(kwargs.items()),
+               sorted(request.args.items(multi=True)), str(get_locale()),
+               roles, zip(tags, get_versions(*tags))]
+        return hashlib.md5(repr(key)).hexdigest()
+
+    def _cached(self, method, timeout):
+        """ Wraps view method to serve successful responses from the
+            `response_cache`, streamed responses are cached once sent
+        """
+        def tee(key, chunks):
+            body = []
+            for chunk in chunks:
+                body.append(chunk)
+                yield chunk
+            response_cache.set(key, ''.join(body), timeout)
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            key = self.get_cache_key(**kwargs)
+            body = response_cache.get(key)
+
+            if body is not None:
+                return current_app.response_class(body,
+                                                  mimetype='application/json')
+
+            response = method(*args, **kwargs)
+            if response.status_code == http.OK:
+                if response.is_streamed:
+                    response.response = tee(key, response.response)
+                else:
+                    response_cache.set(key, response.get_data(), timeout)
+            return response
+
+        return wrapper
+
+    def list_version(self, objects):
+        """ Abstract method, must return pair of the latest `etag_column`
+            value and the amount of objects
+        """
+        raise NotImplementedError()
+
+    def list_etag(self):
+        latest, count = self.list_version(self.get_objects())
+        variant = [latest, count, sorted(request.args.items(multi=True)),
+                   str(get_locale()), session.get('user_id')]
+        return hashlib.md5(repr(variant)).hexdigest()
+
+    def _conditional(self, method):
+        """ Wraps GET view method to tag successful responses with strong
+            ETag and to answer with 304 when the client has them already
+        """
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            etag = None
+            if self.etag_column is not None and not kwargs:
+                etag = self.list_etag()
+                if etag in request.if_none_match:
+                    response = current_app.response_class(
+                        status=http.NOT_MODIFIED)
+                    response.set_etag(etag)
+                    return response
+
+            response = method(*args, **kwargs)
+            if response.status_code != http.OK:
+                return response
+
+            if etag is None and not response.is_streamed:
+                etag = hashlib.md5(response.get_data()).hexdigest()
+
+            if etag is not None:
+                response.set_etag(etag)
+                if get_http_cache(request.endpoint) is None:
+                    # without the declared policy the body may be private,
+                    # clients revalidate it and shared caches don't store it
+                    response.cache_control.private = True
+                    response.cache_control.no_cache = True
+                response.make_conditional(request)
+            return response
+
+        return wrapper
+
     def get_objects(self, *args, **kwargs):
         """abstract method, must be implemented in subclasses,
         like method for extraction objects query.
@@ -60,9 +198,16 @@ class Resource(MethodView):
         """
         raise NotImplemented('Method is not implemented')
 
+    def load_fields(self, objects):
+        """ Restricts loading of the objects to the fields requested with
+            the ``fields`` argument, if the storage supports it
+        """
+        return objects
+
     def _prepare_pagination(self, **kwargs):
         objects = self.get_objects(**kwargs)
-        count = objects.count()
+        count, self.count_method = self.count_strategy.count(self, objects)
+        objects = self.load_fields(objects)
         last_page = int(count / self.page_size) + (count % self.page_size and 1)
 
         page = self.page if self.page < last_page else last_page
@@ -83,6 +228,73 @@ class Resource(MethodView):
     def paginate(self, page, **kwargs):
         raise NotImplemented()
 
+    def _page_objects(self, paging):
+        """ Abstract method, must return lazy query for the objects of the
+            page described by the `_prepare_pagination` result
+        """
+        raise NotImplementedError()
+
+    def stream(self, objects):
+        """ Abstract method, must return iterable over query results which
+            fetches them from the storage by `stream_chunk_size` batches
+        """
+        raise NotImplementedError()
+
+    def query_signature(self, objects):
+        """ Abstract method, must return string uniquely describing the
+            filters set of the query, e.g. for the cache keys
+        """
+        raise NotImplementedError()
+
+    def estimate_count(self, objects):
+        """ Approximate amount of objects taken from the storage statistics
+            or None if the storage can't estimate it for the query
+        """
+        return None
+
+    def _prepare_cursor(self, **kwargs):
+        """ Keyset counterpart of the `_prepare_pagination`, seeks past the
+            position passed with the ``after`` cursor instead of counting
+            and offsetting the whole objects set
+        """
+        objects = self.load_fields(self.get_objects(**kwargs))
+        position = None
+        if self.after:
+            try:
+                position = decode_cursor(self.after)
+            except ValueError:
+                raise t.DataError({'after': 'Invalid cursor'})
+
+            if len(position) != 2:
+                raise t.DataError({'after': 'Invalid cursor'})
+
+        return {
+            'objects': self.seek(objects, position),
+            'page_size': self.page_size
+        }
+
+    def seek(self, objects, position):
+        """ Abstract method, must order objects by the `cursor_key` and
+            the primary key and filter out everything up to the `position`
+            (pair of values for those keys) if it is passed
+        """
+        raise NotImplementedError()
+
+    def cursor_position(self, instance):
+        return [getattr(instance, self.cursor_key), instance.id]
+
+    def paginate_cursor(self, **kwargs):
+        paging = self._prepare_cursor(**kwargs)
+        # fetching one more object tells whether the next page exists
+        items = list(paging['objects'].limit(paging['page_size'] + 1))
+        next_cursor = None
+
+        if len(items) > paging['page_size']:
+            items = items[:paging['page_size']]
+            next_cursor = encode_cursor(self.cursor_position(items[-1]))
+
+        return items, next_cursor, paging['page_size']
+
     # TODO: debug all operations with a page
     # def paginate(self, page=1, page_size=20, **kwargs):
         # page = int(page)
@@ -119,21 +331,87 @@ class Resource(MethodView):
             {'meta': {'total': total objects,
                       'pages': amount pages},
              'objects': objects list}
+        or with the cursor to the next page for keyset pagination:
+            {'meta': {'next': cursor or None},
+             'objects': objects list}
         """
         # Processing fiters passed through the request.args
-
-        items, total, pages, quantity = self.paginate(**kwargs)
+        if self.cursor_key is not None:
+            items, next_cursor, quantity = self.paginate_cursor(**kwargs)
+            meta = {'next': next_cursor, 'quantity': quantity}
+        else:
+            items, total, pages, quantity = self.paginate(**kwargs)
+            meta = {'total': total, 'pages': pages, 'quantity': quantity,
+                    'count_method': self.count_method}
+
+        meta['current_time'] = datetime.utcnow().ctime()
+        items = list(items)
+        self.prefetch(items)
         response = {
-            'meta': {
-                'total': total,
-                'pages': pages,
-                'quantity': quantity,
-                'current_time': datetime.utcnow().ctime(),
-            },
-            'objects': [self.serialize(item) for item in items]
+            'meta': meta,
+            'objects': map(self.list_serializer(), items)
         }
         return response
 
+    def gen_list_stream(self, **kwargs):
+        """ Streaming counterpart of the `gen_list_response`: objects are
+            read from the server side cursor and encoded by chunks, so the
+            whole list is never kept in memory. Meta goes after the objects
+            list, as the cursor to the next page is known at the end only
+        """
+        if self.cursor_key is not None:
+            paging = self._prepare_cursor(**kwargs)
+            objects = paging['objects'].limit(paging['page_size'] + 1)
+            meta = {'next': None, 'quantity': paging['page_size']}
+        else:
+            paging = self._prepare_pagination(**kwargs)
+            objects = self._page_objects(paging)
+            meta = {'total': paging['count'], 'pages': paging['last_page'],
+                    'quantity': paging['page_size'],
+                    'count_method': self.count_method}
+        meta['current_time'] = datetime.utcnow().ctime()
+        serialize = self.list_serializer()
+
+        def encode(chunk):
+            self.prefetch(chunk)
+            return ', '.join(json_dumps(serialize(item)) for item in chunk)
+
+        def generate():
+            yield '{"objects": ['
+            chunk, separator, last = [], '', None
+
+            for position, item in enumerate(self.stream(objects)):
+                if position == paging['page_size']:
+                    meta['next'] = encode_cursor(self.cursor_position(last))
+                    break
+
+                chunk.append(item)
+                last = item
+
+                if len(chunk) == self.stream_chunk_size:
+                    yield separator + encode(chunk)
+                    chunk, separator = [], ', '
+
+            if chunk:
+                yield separator + encode(chunk)
+            yield '], "meta": {}}}'.format(json_dumps(meta))
+
+        return current_app.response_class(stream_with_context(generate()),
+                                          mimetype='application/json')
+
+    def prefetch(self, items):
+        """ Hook loading data for the whole page (or streamed chunk) of
+            objects at once before they are serialized one by one, e.g.
+            values kept in the other storage
+        """
+        pass
+
+    def list_serializer(self):
+        """ Returns function the objects of list responses are serialized
+            with
+        """
+        return self.serialize
+
     def clean(self, data):
         """
         Clean and normalize passed data
@@ -154,10 +432,24 @@ class Resource(MethodView):
             page_size.set_trafaret(t.Int(gt=0))
             # filter set processing
             self.filters_map.keys.append(page_size)
+        if not filter(lambda k: k.name == 'after', self.filters_map.keys):
+            after = t.Key('after', optional=True)
+            after.set_trafaret(t.String)
+            self.filters_map.keys.append(after)
+        if not filter(lambda k: k.name == 'fields', self.filters_map.keys):
+            fields = t.Key('fields', optional=True)
+            fields.set_trafaret(t.String)
+            self.filters_map.keys.append(fields)
         data = self.filters_map.check(request_args.copy())
 
         self.page = data.pop('page', 1)
         self.page_size = data.pop('page_size', self.page_size)
+        self.after = data.pop('after', None)
+
+        fields = data.pop('fields', None)
+        if fields is not None:
+            self.fields = filter(None, map(unicode.strip,
+                                           unicode(fields).split(',')))
 
         return data
 
@@ -167,6 +459,9 @@ class ModelResource(Resource):
     """
     model = None
     validation = t.Dict().allow_extra('*')
+    # loading plan, maps serialized field names to the loader options
+    # (e.g. `joinedload`) of relationships their values are computed from
+    load_options = None
 
     def clean(self, data):
         return self.validation.check(data)
@@ -175,6 +470,8 @@ class ModelResource(Resource):
         status = http.OK
         try:
             if id is None:
+                if self.streaming:
+                    return self.gen_list_stream()
                 response = self.gen_list_response()
             else:
                 response = self.serialize(self.get_object(id))
@@ -226,24 +523,166 @@ class ModelResource(Resource):
         query_args = self._filter(kwargs)
         return self.model.query.filter_by(**query_args)
 
+    def list_version(self, objects):
+        column = getattr(self.model, self.etag_column)
+        return objects.order_by(None) \
+                    .with_entities(func.max(column), func.count()).one()
+
+    def load_fields(self, objects):
+        options = self._load_options()
+        columns = self._loaded_fields()
+        if columns:
+            options.append(load_only(*columns))
+        if options:
+            return objects.options(*options)
+        return objects
+
+    def _load_options(self):
+        """ Loader options of the `load_options` plan for the fields being
+            serialized, either requested ones or all of them
+        """
+        if not self.load_options:
+            return []
+
+        options = []
+        for field in self.fields or self.load_options.keys():
+            for option in self.load_options.get(field, ()):
+                if not any(option is added for added in options):
+                    options.append(option)
+        return options
+
+    def prefetch(self, items):
+        """ Loads translations of the multilingual models for all the items
+            at once
+        """
+        if hasattr(self.model, 'load_translations'):
+            self.model.load_translations(items)
+
+    def list_serializer(self):
+        """ In debug mode serialization is checked for queries repeated per
+            object, e.g. lazy loads missing from the `load_options` plan
+        """
+        if not current_app.debug:
+            return self.serialize
+
+        # objects serialization of which has hit the database
+        hits = []
+
+        def serialize(instance):
+            executed = len(get_debug_queries())
+            result = self.serialize(instance)
+            queries = get_debug_queries()[executed:]
+            if queries:
+                hits.append(queries)
+            if len(hits) == 2:
+                self._report_lazy_loads(queries)
+            return result
+
+        return serialize
+
+    def _report_lazy_loads(self, queries):
+        message = "{} queries the database serializing every object: {}" \
+                    .format(self.__class__.__name__,
+                            '; '.join(q.statement for q in queries))
+        # declared plan is expected to cover everything serialized
+        assert not self.load_options, message
+        current_app.logger.warning(message)
+
+    def serializable_fields(self):
+        """ Names of the fields `serialize` outputs, the ones requested with
+            the ``fields`` argument are checked against them
+        """
+        return self.model.serializable_fields()
+
+    def _storage_fields(self):
+        """ Mapping of the exported field names to the model attributes
+            loaded from the storage
+        """
+        return dict((p.key.strip('_'), p.key)
+                    for p in self.model.__mapper__.iterate_properties
+                    if isinstance(p, ColumnProperty))
+
+    def _loaded_fields(self):
+        """ Checks names passed with the ``fields`` argument against the
+            serialized ones and returns attributes the loading could be
+            restricted to. Objects are loaded completely if any of requested
+            fields is computed, as we don't know what attributes it depends
+            on
+        """
+        if not self.fields:
+            return None
+
+        serializable = self.serializable_fields()
+        unknown = [f for f in self.fields if f not in serializable]
+        if unknown:
+            raise t.DataError({
+                'fields': "Unknown fields: {}".format(', '.join(unknown))
+            })
+
+        storage_fields = self._storage_fields()
+        if all(f in storage_fields for f in self.fields):
+            return [storage_fields[f] for f in self.fields]
+        return None
+
     def get_object(self, id):
         """ Method for extracting single object for requested id regarding
             on previous filters applied
         """
-        return self.get_objects(id=id).first_or_404()
+        return self.load_fields(self.get_objects(id=id)).first_or_404()
 
     def paginate(self, **kwargs):
         paging = self._prepare_pagination(**kwargs)
-        items = paging['objects'].limit(paging['page_size']) \
-                    .offset(paging['offset'])
+        items = self._page_objects(paging)
         return items, paging['count'], paging['last_page'], paging['page_size']
 
-    @classmethod
-    def serialize(cls, instance, include=None):
+    def _page_objects(self, paging):
+        return paging['objects'].limit(paging['page_size']) \
+                    .offset(paging['offset'])
+
+    def stream(self, objects):
+        # the query is executed after the session commit in the
+        # `close_session` hook, when the response body is iterated
+        return objects.yield_per(self.stream_chunk_size) \
+                    .execution_options(stream_results=True)
+
+    def query_signature(self, objects):
+        statement = objects.statement.compile()
+        return "{}{!r}".format(statement, sorted(statement.params.items()))
+
+    def estimate_count(self, objects):
+        """ Reads the rows amount postgres keeps in the table statistics,
+            filtered queries can't be estimated this way
+        """
+        if objects.whereclause is not None:
+            return None
+
+        query = text("SELECT reltuples FROM pg_class "
+                     "WHERE oid = CAST(:table AS regclass)")
+        estimate = db.session.execute(query,
+                                      {'table': self.model.__table__.name},
+                                      mapper=self.model).scalar()
+        # tables never analyzed have no statistics yet
+        if estimate is None or estimate < 0:
+            return None
+        return int(estimate)
+
+    def seek(self, objects, position):
+        key, pk = getattr(self.model, self.cursor_key), self.model.id
+
+        if self.cursor_key == 'id':
+            if position is not None:
+                objects = objects.filter(pk > position[1])
+            return objects.order_by(pk)
+
+        if position is not None:
+            objects = objects.filter(tuple_(key, pk) > tuple_(*position))
+        return objects.order_by(key, pk)
+
+    def serialize(self, instance, include=None):
         """ Method to controls model serialization in derived classes
         :rtype : dict
         """
-        return instance.as_dict(include=include)
+        return instance.as_dict(include=include, only=self.fields)
 
 
 class MongoResource(ModelResource):
@@ -272,14 +711,63 @@ class MongoResource(ModelResource):
         query_args = self._filter(kwargs)
         return self.model.objects(**query_args)
 
+    def list_version(self, objects):
+        latest = objects.order_by('-' + self.etag_column) \
+                    .scalar(self.etag_column).first()
+        return latest, objects.count()
+
+    def load_fields(self, objects):
+        fields = self._loaded_fields()
+        if fields:
+            return objects.only(*fields)
+        return objects
+
+    def _storage_fields(self):
+        return dict((name, name) for name in self.model._fields
+                    if not name.startswith('_'))
+
     def get_object(self, id):
         """ Method for extracting single object for requested id regarding
             on previous filters applied
         """
-        return self.get_objects(pk=id).get_or_404()
+        return self.load_fields(self.get_objects(pk=id)).get_or_404()
 
     def paginate(self, **kwargs):
         paging = self._prepare_pagination(**kwargs)
         pager = paging['objects'].paginate(paging['page'], paging['page_size'])
         return (pager.items, paging['count'], paging['last_page'],
                 paging['page_size'])
+
+    def _page_objects(self, paging):
+        return paging['objects'].skip(paging['offset']) \
+                    .limit(paging['page_size'])
+
+    def stream(self, objects):
+        return objects.batch_size(self.stream_chunk_size)
+
+    def query_signature(self, objects):
+        return json.dumps(objects._query, sort_keys=True, cls=CustomEncoder)
+
+    def estimate_count(self, objects):
+        if objects._query:
+            return None
+
+        collection = self.model._get_collection()
+        # pymongo before 3.7 counts by collection metadata without filter
+        estimate = getattr(collection, 'estimated_document_count',
+                           collection.count)
+        return estimate()
+
+    def seek(self, objects, position):
+        key = self.cursor_key
+
+        if key == 'id':
+            if position is not None:
+                objects = objects.filter(pk__gt=position[1])
+            return objects.order_by('id')
+
+        if position is not None:
+            value, pk = position
+            objects = objects.filter(Q(**{key + '__gt': value}) |
+                                     Q(**{key: value, 'pk__gt': pk}))
+        return objects.order_by(key, 'id')
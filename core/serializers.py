@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bson import ObjectId
+from datetime import datetime
+from itertools import chain, izip
+from operator import attrgetter
+from speaklater import _LazyString
+
+
+__all__ = ['CONVERTERS', 'compile_serializer', 'get_serializer']
+
+# values of these types are converted the same way `CustomEncoder` does it,
+# so serialized dictionaries could be dumped without encoder fallbacks,
+# others, e.g. decimals, are left for the encoder as they were before
+CONVERTERS = {
+    datetime: datetime.ctime,
+    ObjectId: str,
+    _LazyString: unicode,
+}
+
+# compiled serializers are cached per class and fields selection, the cache
+# is dropped as a whole if clients request too many distinct selections
+MAX_SERIALIZERS = 1024
+
+_serializers = {}
+
+
+def _is_method(cls, name):
+    """ Checks whether the attribute is called to get its value, the way
+        callable values were treated before serializers were compiled.
+        Data descriptors, i.e. columns, fields and (hybrid) properties, are
+        values and are not accessed on the class: class level access to
+        hybrid properties evaluates their expressions
+    """
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            attr = klass.__dict__[name]
+            if hasattr(attr, '__set__') or hasattr(attr, '__delete__'):
+                return False
+            return callable(getattr(cls, name))
+    return False
+
+
+def _make_getter(names):
+    if not names:
+        return lambda instance: ()
+    if len(names) == 1:
+        name = names[0]
+        return lambda instance: (getattr(instance, name),)
+    return attrgetter(*names)
+
+
+def _convert(value, get_converter=CONVERTERS.get):
+    converter = get_converter(type(value))
+    if converter is None:
+        return value
+    return converter(value)
+
+
+def compile_serializer(cls, fields):
+    """ Builds function serializing `cls` instances into dictionaries with
+        the `fields` keys. Methods listed in `fields` are called and their
+        results are exported
+    """
+    methods = tuple(name for name in fields if _is_method(cls, name))
+    values = tuple(name for name in fields if name not in methods)
+    names = values + methods
+    get_values = _make_getter(values)
+
+    def serializer(instance):
+        results = chain(get_values(instance),
+                        (getattr(instance, name)() for name in methods))
+        return dict(izip(names, map(_convert, results)))
+
+    return serializer
+
+
+def get_serializer(cls, include=None, exclude=None, only=None):
+    """ Returns compiled serializer for the exportable fields of the `cls`
+        (as listed by its `exportable_fields` classmethod) extended with
+        `include`, reduced with `exclude` and restricted to `only` fields
+    """
+    include, exclude = frozenset(include or ()), frozenset(exclude or ())
+    if only is not None:
+        only = frozenset(only)
+
+    key = (cls, include, exclude, only)
+    serializer = _serializers.get(key)
+
+    if serializer is None:
+        fields = (set(cls.exportable_fields()) | include) - exclude
+        if only is not None:
+            fields &= only
+
+        if len(_serializers) >= MAX_SERIALIZERS:
+            _serializers.clear()
+        serializer = _serializers[key] = compile_serializer(cls, fields)
+
+    return serializer
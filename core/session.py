@@ -1,29 +1,108 @@
-from datetime import timedelta
+import copy
 import pickle
+import time
+from datetime import timedelta
 from uuid import uuid4
 from flask.sessions import SessionMixin, SessionInterface
+from flamaster.core.codec import SessionCodec
 from flamaster.extensions import redis
 from werkzeug.datastructures import CallbackDict
 
 
+# endpoints served without the session, see `exempt_session`
+session_exempt = set(['static'])
+# stored along with the session data, time its expiration was prolonged at
+TOUCHED_KEY = '_touched'
+
+
+def exempt_session(*endpoints):
+    """ Opts endpoints out of sessions: their session is always empty and
+        changes of it are dropped, so they never read or write redis
+    """
+    session_exempt.update(endpoints)
+
 
 class RedisSession(CallbackDict, SessionMixin):
+    """ Session data is read from redis on the first access only, session
+        which is never accessed during the request costs nothing. Data as
+        it was loaded is kept to save the session only if it is changed
+    """
 
-    def __init__(self, initial=None, sid=None, new=False):
+    def __init__(self, sid=None, new=False, loader=None, exempt=False):
         def on_update(self):
             self.modified = True
-        CallbackDict.__init__(self, initial, on_update)
-        self.sid = self['id'] = sid
+        CallbackDict.__init__(self, None, on_update)
+        self.sid = sid
         self.new = new
+        self.exempt = exempt
         self.modified = False
+        self.loaded = False
+        self.original = None
+        self.touched = None
+        self.persistent = False
+        self._loader = loader
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.exempt:
+            return
+
+        data = self._loader is not None and self._loader() or {}
+        self.touched = data.pop(TOUCHED_KEY, None)
+        data.setdefault('id', self.sid)
+        # filled bypassing `on_update`, loading isn't the modification
+        dict.update(self, data)
+        self.original = copy.deepcopy(data)
+
+    def persist(self):
+        """ Makes the new session stored even if nothing is changed in it,
+            so its id stays the same for the following requests
+        """
+        self.load()
+        self.persistent = True
+
+    @property
+    def changed(self):
+        return self.loaded and dict(self) != self.original
+
+
+def _loading(name):
+    method = getattr(CallbackDict, name)
+
+    def loading(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    loading.__name__ = name
+    return loading
+
+
+# every access to the session data loads it first
+for _method in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+                '__iter__', '__len__', '__eq__', '__ne__', '__repr__', 'get',
+                'has_key', 'keys', 'values', 'items', 'iterkeys',
+                'itervalues', 'iteritems', 'pop', 'popitem', 'setdefault',
+                'update', 'clear', 'copy'):
+    setattr(RedisSession, _method, _loading(_method))
 
 
 class RedisSessionInterface(SessionInterface):
-    serializer = pickle
+    """ Sessions stored in redis by the id kept in the cookie. Session is
+        written, and the cookie is set, only if its data is changed or its
+        expiration was prolonged more than `refresh_interval` seconds ago
+    """
     session_class = RedisSession
+    refresh_interval = 600
 
-    def __init__(self, prefix='session:'):
+    def __init__(self, prefix='session:', legacy_pickle=False):
+        """ Pickled sessions stored before the codec are read with
+            `legacy_pickle` only, pickle is unsafe if redis is shared and
+            should be left disabled once they are expired
+        """
         self.prefix = prefix
+        # any object with `dumps` and `loads`
+        self.serializer = SessionCodec(legacy=legacy_pickle and pickle or None)
 
     def generate_sid(self):
         return str(uuid4())
@@ -35,26 +114,48 @@ class RedisSessionInterface(SessionInterface):
 
     def open_session(self, app, request):
         sid = request.cookies.get(app.session_cookie_name)
+        if request.endpoint in session_exempt:
+            return self.session_class(sid=sid, exempt=True)
         if not sid:
-            sid = self.generate_sid()
-            return self.session_class(sid=sid)
+            return self.session_class(sid=self.generate_sid(), new=True)
+        return self.session_class(sid=sid, loader=lambda: self.load(sid))
+
+    def load(self, sid):
         val = redis.get(self.prefix + sid)
-        if val is not None:
+        if val is None:
+            return {}
+        try:
             data = self.serializer.loads(val)
-            return self.session_class(data, sid=sid)
-        return self.session_class(sid=sid, new=True)
+        except Exception:
+            # unreadable session, whatever has failed decoding it, is
+            # started over as the empty one
+            return {}
+        return isinstance(data, dict) and data or {}
 
     def save_session(self, app, session, response):
+        if session.exempt or not session.loaded:
+            return
+
         domain = self.get_cookie_domain(app)
         if not session:
-            redis.delete(self.prefix + session.sid)
-            if session.modified:
+            if not session.new:
+                redis.delete(self.prefix + session.sid)
                 response.delete_cookie(app.session_cookie_name,
                                        domain=domain)
             return
+
+        now = int(time.time())
+        if not session.changed:
+            fresh = (session.touched is not None and
+                     now - session.touched < self.refresh_interval)
+            if fresh or (session.new and not session.persistent):
+                return
+
         redis_exp = self.get_redis_expiration_time(app, session)
         cookie_exp = self.get_expiration_time(app, session)
-        val = self.serializer.dumps(dict(session))
+        data = dict(session)
+        data[TOUCHED_KEY] = now
+        val = self.serializer.dumps(data)
         redis.setex(self.prefix + session.sid, int(redis_exp.total_seconds()),
                     val)
         response.set_cookie(app.session_cookie_name, session.sid,
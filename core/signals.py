@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from blinker import Namespace
+from mongoengine import signals as mongo_signals
+
+
+__all__ = ['model_changed']
+
+signals = Namespace()
+
+# sent with the model class as sender and the instance as the keyword
+# argument every time a sqlalchemy or mongoengine object is saved or removed
+model_changed = signals.signal('model-changed')
+
+
+@mongo_signals.post_save.connect
+def document_saved(sender, document, **kwargs):
+    model_changed.send(sender, instance=document)
+
+
+@mongo_signals.post_delete.connect
+def document_deleted(sender, document, **kwargs):
+    model_changed.send(sender, instance=document)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+
+from bson import json_util
+from mongoengine.connection import get_db
+from pymongo import CursorType
+from pymongo.errors import OperationFailure
+
+from flamaster.extensions import redis
+
+from .indexer import index, logger
+
+
+__all__ = ['ChangeTailer']
+
+
+class ChangeTailer(object):
+    """ Keeps the search index consistent with everything written to the
+        collections of registered documents, no matter who has written it.
+        Changes are read from the database change stream, or from the oplog
+        on servers without change streams, and indexed by batches. Position
+        in the stream is saved in redis after each indexed batch, so the
+        tailer continues from it after restart
+    """
+    token_key = 'index:resume'
+
+    def __init__(self, batch_size=500, interval=1.0):
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def collections(self):
+        """ Registered classes by their collections, class stored in the
+            collection along with its subclasses goes first
+        """
+        collections = {}
+        for cls in sorted(index.registry, key=lambda c: len(c.__mro__),
+                          reverse=True):
+            collections[cls._get_collection_name()] = cls
+        return collections
+
+    def load_token(self):
+        token = redis.get(self.token_key)
+        return token and json_util.loads(token) or {}
+
+    def save_token(self, kind, token):
+        redis.set(self.token_key,
+                  json_util.dumps({'kind': kind, 'token': token}))
+
+    def run(self):
+        index._patch_encoder()
+        collections = self.collections()
+        stream = self.open_stream(collections)
+
+        if stream is None:
+            self.tail_oplog(collections)
+        else:
+            self.watch(stream, collections)
+
+    def open_stream(self, collections):
+        saved = self.load_token()
+        resume_after = saved.get('kind') == 'stream' and saved['token'] or None
+        pipeline = [{'$match': {'ns.coll': {'$in': collections.keys()}}}]
+
+        try:
+            return get_db().watch(pipeline, resume_after=resume_after,
+                                  max_await_time_ms=int(self.interval * 1000))
+        except (AttributeError, OperationFailure) as err:
+            # pymongo or server without change streams support
+            logger.info("Change streams unavailable (%s), tailing oplog", err)
+            return None
+
+    def watch(self, stream, collections):
+        with stream:
+            batch = Batch(self.batch_size, self.interval)
+            while stream.alive:
+                event = stream.try_next()
+                if event is not None and 'documentKey' in event:
+                    cls = collections[event['ns']['coll']]
+                    key = index.get_key(cls, event['documentKey']['_id'])
+                    batch.add(key, event['_id'])
+                if batch.is_ready():
+                    self.flush(batch, 'stream')
+
+    def tail_oplog(self, collections):
+        db = get_db()
+        namespaces = dict(("{}.{}".format(db.name, name), cls)
+                          for name, cls in collections.iteritems())
+        oplog = db.client.local.oplog.rs
+
+        saved = self.load_token()
+        if saved.get('kind') == 'oplog':
+            position = saved['token']
+        else:
+            # starting from now, earlier changes need the full reindex
+            position = oplog.find().sort('$natural', -1).limit(1)[0]['ts']
+
+        batch = Batch(self.batch_size, self.interval)
+        while True:
+            cursor = oplog.find({'ts': {'$gt': position},
+                                 'ns': {'$in': namespaces.keys()}},
+                                cursor_type=CursorType.TAILABLE_AWAIT,
+                                oplog_replay=True)
+            while cursor.alive:
+                for entry in cursor:
+                    position = entry['ts']
+                    # updates keep document id in the `o2`
+                    document = entry.get('o2') or entry['o']
+                    if '_id' in document:
+                        cls = namespaces[entry['ns']]
+                        batch.add(index.get_key(cls, document['_id']),
+                                  position)
+                    if batch.is_ready():
+                        self.flush(batch, 'oplog')
+                if batch.is_ready():
+                    self.flush(batch, 'oplog')
+            time.sleep(self.interval)
+
+    def flush(self, batch, kind):
+        """ Indexes the batch until elasticsearch accepts it, then saves
+            the stream position of the batch
+        """
+        while not index.flush(batch.keys, requeue=False):
+            time.sleep(self.interval)
+        self.save_token(kind, batch.token)
+        batch.clear()
+
+
+class Batch(object):
+    """ Keys of the changed documents collected until there are `size` of
+        them or the first of them waits for `interval` seconds
+    """
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.clear()
+
+    def clear(self):
+        self.keys, self.token, self.started = set(), None, None
+
+    def add(self, key, token):
+        if self.started is None:
+            self.started = time.time()
+        self.keys.add(key)
+        self.token = token
+
+    def is_ready(self):
+        if not self.keys:
+            return False
+        return (len(self.keys) >= self.size or
+                time.time() - self.started >= self.interval)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import defaultdict
+from threading import Lock
+
+from flamaster.extensions import db
+
+from .cache import get_versions, storage_name
+
+
+__all__ = ['TreeSnapshot', 'get_snapshot']
+
+
+class TreeSnapshot(object):
+    """ Immutable structure of the whole `TreeNode` model table, answers
+        tree queries with dictionary lookups instead of the database ones.
+        Snapshot is built from (id, parent_id) pairs in depth-first order,
+        which is the materialized path order
+    """
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        order, position = [], {}
+        children, ancestors = defaultdict(list), {}
+
+        for node_id, parent_id in rows:
+            position[node_id] = len(order)
+            order.append(node_id)
+            children[parent_id].append(node_id)
+            if parent_id is None:
+                ancestors[node_id] = ()
+            else:
+                ancestors[node_id] = ancestors[parent_id] + (parent_id,)
+
+        # descendants of the node follow it in depth-first order, so the
+        # subtree is the slice of the nodes list as long as its size
+        size = dict.fromkeys(order, 1)
+        for node_id in reversed(order):
+            for child_id in children.get(node_id, ()):
+                size[node_id] += size[child_id]
+
+        self._order = tuple(order)
+        self._parents = dict(rows)
+        self._children = dict((k, tuple(v)) for k, v in children.iteritems())
+        self._ancestors = ancestors
+        self._ranges = dict((node_id, (position[node_id],
+                                       position[node_id] + size[node_id]))
+                            for node_id in order)
+
+    @classmethod
+    def build(cls, model, version=None):
+        rows = db.session.query(model.id, model.parent_id) \
+                    .order_by(model.mp_tree_id, model.mp_path).all()
+        return cls([tuple(row) for row in rows], version)
+
+    def __contains__(self, node_id):
+        return node_id in self._parents
+
+    def __len__(self):
+        return len(self._order)
+
+    def parent(self, node_id):
+        return self._parents[node_id]
+
+    def children(self, node_id=None):
+        """ Children ids of the node, roots ids if `node_id` is None
+        """
+        return self._children.get(node_id, ())
+
+    def ancestors(self, node_id, and_self=False):
+        """ Ids of the node ancestors starting from the root, e.g. for the
+            breadcrumbs
+        """
+        ancestors = self._ancestors[node_id]
+        if and_self:
+            return ancestors + (node_id,)
+        return ancestors
+
+    def descendants(self, node_id, and_self=False):
+        """ Ids of the whole subtree of the node in depth-first order
+        """
+        start, end = self._ranges[node_id]
+        if not and_self:
+            start += 1
+        return self._order[start:end]
+
+    def is_descendant(self, node_id, ancestor_id):
+        return ancestor_id in self._ancestors[node_id]
+
+
+_snapshots = {}
+_lock = Lock()
+
+
+def get_snapshot(model):
+    """ Returns the tree snapshot of the model kept by the process. The
+        snapshot is rebuilt once the model version is bumped, which happens
+        on every save, update or removal of the model nodes
+    """
+    tag = storage_name(model)
+    # version is read before the tree, so the snapshot is never newer
+    # than the data it is built from
+    version, = get_versions(tag)
+    snapshot = _snapshots.get(tag)
+
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            snapshot = _snapshots.get(tag)
+            if snapshot is None or snapshot.version != version:
+                snapshot = TreeSnapshot.build(model, version)
+                _snapshots[tag] = snapshot
+
+    return snapshot
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import base64
+import calendar
 import re
 import types
 import uuid
 
 from bson import ObjectId
-from datetime import datetime
+from bson.errors import InvalidId
+from datetime import datetime, timedelta
 from flask import current_app, render_template, json, Blueprint
 from importlib import import_module
 from time import time
@@ -39,8 +42,66 @@ class LazyResource(LazyView):
         return resource_cls.as_view(self.endpoint)
 
 
-def add_api_rule(bp, endpoint, pk_def, import_name):
+class HTTPCachePolicy(object):
+    """ Caching rules sent to browsers and shared caches with successful
+        responses of an endpoint. `max_age` limits private caches, while
+        `s_maxage` and `stale_while_revalidate` are meant for the CDN
+    """
+
+    def __init__(self, max_age=0, s_maxage=None, stale_while_revalidate=None,
+                 public=True, vary=()):
+        self.max_age = max_age
+        self.s_maxage = s_maxage
+        self.stale_while_revalidate = stale_while_revalidate
+        self.public = public
+        self.vary = tuple(vary)
+
+    @cached_property
+    def cache_control(self):
+        directives = [self.public and 'public' or 'private',
+                      'max-age={}'.format(self.max_age)]
+        if self.s_maxage is not None:
+            directives.append('s-maxage={}'.format(self.s_maxage))
+        if self.stale_while_revalidate is not None:
+            directives.append('stale-while-revalidate={}'.format(
+                              self.stale_while_revalidate))
+        return ', '.join(directives)
+
+    def apply(self, response):
+        response.headers['Cache-Control'] = self.cache_control
+        for header in self.vary:
+            response.vary.add(header)
+        return response
+
+
+# responses translated with the request locale have to be cached per
+# headers `get_locale` selects the language with, the session locale isn't
+# used for endpoints with the public policy, cookies are unique per client
+LOCALE_VARY = ('X-Client-Locale', 'Accept-Language')
+
+# endpoint name -> HTTPCachePolicy, filled with `http_cache` arguments of
+# the routing helpers and looked up by `factory.modify_headers`
+http_cache_policies = {}
+
+
+def set_http_cache(endpoint, policy):
+    """ Declares caching policy for the endpoint, `policy` is either
+        `HTTPCachePolicy` or dictionary of its arguments
+    """
+    if policy is None:
+        return
+    if isinstance(policy, dict):
+        policy = HTTPCachePolicy(**policy)
+    http_cache_policies[endpoint] = policy
+
+
+def get_http_cache(endpoint):
+    return http_cache_policies.get(endpoint)
+
+
+def add_api_rule(bp, endpoint, pk_def, import_name, http_cache=None):
     resource = LazyResource(import_name, endpoint)
+    set_http_cache("{}.{}".format(bp.name, endpoint), http_cache)
     collection_url = "/{}/".format(endpoint)
     # collection endpoint
     collection_methods = ['GET', 'PUT', 'POST']
@@ -60,8 +121,11 @@ def add_api_rule(bp, endpoint, pk_def, import_name):
                     methods=item_methods)
 
 
-def add_url_rule(blueprint, namespace, path, method, **kwargs):
+def add_url_rule(blueprint, namespace, path, method, http_cache=None,
+                 **kwargs):
     method_path = ".".join([namespace, method])
+    endpoint = kwargs.get('endpoint', method)
+    set_http_cache("{}.{}".format(blueprint.name, endpoint), http_cache)
     return blueprint.add_url_rule(path, view_func=LazyView(method_path),
                                   **kwargs)
 
@@ -99,6 +163,47 @@ def jsonify_status_code(data=None, status=200, mimetype='application/json'):
                                       status=status, mimetype=mimetype)
 
 
+def _pack_cursor_value(value):
+    if isinstance(value, datetime):
+        timestamp = calendar.timegm(value.utctimetuple())
+        return {'$date': timestamp * 10 ** 6 + value.microsecond}
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    return value
+
+
+def _unpack_cursor_value(value):
+    if isinstance(value, dict):
+        if '$date' in value:
+            return datetime(1970, 1, 1) + \
+                timedelta(microseconds=value['$date'])
+        if '$oid' in value:
+            return ObjectId(value['$oid'])
+    return value
+
+
+def encode_cursor(values):
+    """ Packs sort key values of the last seen object into an opaque
+        url-safe token for the keyset pagination
+    """
+    data = json.dumps(map(_pack_cursor_value, values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(token):
+    """ Unpacks values encoded with `encode_cursor`, raises `ValueError`
+        for the malformed tokens
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        values = json.loads(data)
+        if not isinstance(values, list):
+            raise TypeError('Cursor should contain a list of values')
+        return map(_unpack_cursor_value, values)
+    except (InvalidId, TypeError, UnicodeError):
+        raise ValueError('Malformed cursor: {!r}'.format(token))
+
+
 def slugify(text, separator='-', prefix=True):
     text = unidecode(text)
     text = re.sub('[^\w\s]', '', text)
@@ -142,6 +247,25 @@ def resolve_class(class_path):
     return getattr(import_module(module_name), class_name)
 
 
+def by_languages(translations):
+    """ Texts of the multilingual value by the ``LANGUAGES`` codes, from
+        its translations keyed by locales, e.g. `en_US`. Languages the
+        value isn't translated to get the ``MONGODB_FALLBACK_LANG`` text
+    """
+    languages = current_app.config['LANGUAGES']
+    texts = {}
+    for locale, text in translations.iteritems():
+        language = locale.split('_', 1)[0].lower()
+        if language in languages and text:
+            texts[language] = text
+
+    fallback = texts.get(current_app.config['MONGODB_FALLBACK_LANG'])
+    if fallback is not None:
+        for language in languages:
+            texts.setdefault(language, fallback)
+    return texts
+
+
 def rules(language):
     """ helper method for getting plural form rules from the text file
     """
@@ -242,12 +366,13 @@ def x_accel_gridfs(file_field):
 
 class ResourceBlueprint(Blueprint):
 
-    def add_resource(self, endpoint, pk_def, class_name):
+    def add_resource(self, endpoint, pk_def, class_name, http_cache=None):
         if class_name.startswith('.'):
             import_path = "{}.api{}".format(self.import_name, class_name)
         else:
             import_path = class_name
         resource = LazyResource(import_path, endpoint)
+        set_http_cache("{}.{}".format(self.name, endpoint), http_cache)
         collection_url = "/{}/".format(endpoint)
 
         # collection endpoint
@@ -265,6 +390,8 @@ class ResourceBlueprint(Blueprint):
         self.add_url_rule(collection_url, view_func=resource, endpoint=endpoint, methods=collection_methods)
         self.add_url_rule(item_url, view_func=resource, endpoint=endpoint, methods=item_methods)
 
-    def add_view(self, path, method, **kwargs):
+    def add_view(self, path, method, http_cache=None, **kwargs):
         import_path = "{}.views.{}".format(self.import_name, method)
+        endpoint = kwargs.get('endpoint', method)
+        set_http_cache("{}.{}".format(self.name, endpoint), http_cache)
         return self.add_url_rule(path, view_func=LazyView(import_path), **kwargs)
\ No newline at end of file
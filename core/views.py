@@ -3,6 +3,7 @@ from jinja2.exceptions import TemplateNotFound
 from flask import abort, render_template, current_app
 
 from . import core
+from .utils import set_http_cache, LOCALE_VARY
 
 
 __all__ = ['index', 'template']
@@ -22,3 +23,8 @@ def template(template=None):
         return render_template(current_app.jinja_env.get_template(template))
     except TemplateNotFound:
         abort(404)
+
+
+set_http_cache('core.template', {'max_age': 300, 's_maxage': 3600,
+                                 'stale_while_revalidate': 300,
+                                 'vary': LOCALE_VARY})
@@ -1,20 +1,19 @@
 from __future__ import absolute_import
 import os
 import time
-import uuid
 from datetime import datetime
 import logging
 from logging.handlers import SMTPHandler
 
 from flask import (Flask, abort, g, request, session, render_template,
                    current_app)
-from flask.ext.babel import get_locale as babel_locale
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.utils import import_string
 
 from flamaster.account import user_ds, connection_ds
 from flamaster.core import http
 from flamaster.core.session import RedisSessionInterface
+from flamaster.core.utils import get_http_cache
 from flamaster.extensions import register_jinja_helpers
 
 
@@ -47,7 +46,8 @@ class AppFactory(object):
         self._register_blueprints(app)
         self._register_hooks(app)
 
-        app.session_interface = RedisSessionInterface()
+        app.session_interface = RedisSessionInterface(
+            legacy_pickle=app.config.get('SESSION_LEGACY_PICKLE', False))
         app.wsgi_app = ProxyFix(app.wsgi_app)
         return app
 
@@ -132,7 +132,17 @@ class AppFactory(object):
 
 
 def modify_headers(response):
-    map(lambda h: response.headers.add(*h), current_app.config['HEADERS'])
+    # declared caching policy applies to successful reads only, errors and
+    # responses to writes get the default non-cacheable headers
+    policy = get_http_cache(request.endpoint)
+    if (policy is not None and request.method in ('GET', 'HEAD') and
+            response.status_code in (http.OK, http.NOT_MODIFIED)):
+        policy.apply(response)
+
+    # headers set by the view itself, e.g. caching ones, are kept intact
+    for header, value in current_app.config['HEADERS']:
+        if header not in response.headers:
+            response.headers.add(header, value)
     return response
 
 def close_session(response):
@@ -142,9 +152,9 @@ def close_session(response):
     return response
 
 def setup_session():
+    # locale isn't resolved here, selecting it may load the session, which
+    # is read only by the requests using it, see `current_language`
     g.now = time.mktime(datetime.utcnow().timetuple())
-    g.locale = babel_locale().language
-    session['id'] = session.get('id', uuid.uuid4().hex)
 
 
 def show_internal_error(error):
@@ -160,14 +170,28 @@ def show_page_not_found(error):
 
 def get_locale(app):
     def closure():
+        key = app.config['LOCALE_KEY']
         language = request.headers.get('X-Client-Locale', None)
+
+        policy = get_http_cache(request.endpoint)
+        if policy is not None and policy.public:
+            # responses shared by caches depend on the `LOCALE_VARY`
+            # headers only, the session isn't read or written
+            if language is None:
+                languages = app.config['ACCEPT_LANGUAGES']
+                language = request.accept_languages.best_match(languages)
+            return language
+
         if language is None:
             languages = app.config['ACCEPT_LANGUAGES']
             matched = request.accept_languages.best_match(languages)
 
-            language = session.get(app.config['LOCALE_KEY'], matched)
+            language = session.get(key, matched)
+        elif session.get(key) != language:
+            # locale chosen by the client is remembered for the requests
+            # without the header
+            session[key] = language
 
-        session[app.config['LOCALE_KEY']] = language
         return language
 
     return closure
@@ -15,6 +15,7 @@ class FlatPageResource(ModelResource):
     validation = t.Dict({'name': t.String,
                          'content': t.String}).ignore_extra('*')
     model = FlatPage
+    cache_policy = {'get': 300}
     method_decorators = {'post': roles_required('admin'),
                          'put': roles_required('admin'),
                          'delete': roles_required('admin')}
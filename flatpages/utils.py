@@ -1,25 +1,85 @@
 # encoding: utf-8
 from __future__ import absolute_import
+from collections import namedtuple
+from threading import Lock
 
 from flask import render_template, request, current_app
+from flask.ext.babel import get_locale
 from flask.ext.security import login_required
 
+from flamaster.core.cache import TwoTierCache, get_versions, storage_name
+from flamaster.extensions import db
+
 from . import bp
 from .models import FlatPage
 
 
+PageInfo = namedtuple('PageInfo', 'id template_name registration_required')
+
+
+class SlugIndex(object):
+    """ Slugs of all the flatpages kept by the process, so paths without
+        pages are rejected without queries. Index is reloaded as soon as
+        the pages version is bumped by their save or removal
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.version = None
+        self.pages = {}
+        self._lock = Lock()
+
+    def get(self, slug):
+        version, = get_versions(storage_name(self.model))
+
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.pages = self._load()
+                    self.version = version
+
+        return self.pages.get(slug)
+
+    def _load(self):
+        model = self.model
+        rows = db.session.query(model.slug, model.id, model.template_name,
+                                model.registration_required)
+        return dict((row[0], PageInfo(*row[1:])) for row in rows)
+
+
+slug_index = SlugIndex(FlatPage)
+# rendered pages by slug, template, locale and pages version
+page_cache = TwoTierCache('flatpage:', size=128)
+
+
+def render_page(page_id, template):
+    return render_template(template, page=FlatPage.query.get(page_id))
+
+
+def cached_page(slug, page, template, timeout=3600):
+    key = ':'.join([slug, template, unicode(get_locale()),
+                    str(slug_index.version)]).encode('utf-8')
+    content = page_cache.get(key)
+    if content is None:
+        content = render_page(page.id, template).encode('utf-8')
+        page_cache.set(key, content, timeout)
+    return content
+
+
 # TODO: need to decide, how we handle 404 error?
 @bp.after_app_request
 def view_flatpage(response):
     if response.status_code == 404:
         path = request.path.strip('/')
-        page = FlatPage.query.filter_by(slug=path).first()
+        page = slug_index.get(path)
         if page is not None:
             template = page.template_name or 'flatpage.html'
-            make_content = render_template
             if page.registration_required is True:
-                make_content = login_required(render_template)
-            return current_app.make_response(make_content(template, page=page))
+                # content depends on the user, it is rendered every time
+                content = login_required(render_page)(page.id, template)
+            else:
+                content = cached_page(path, page, template)
+            return current_app.make_response(content)
 
     return response
 
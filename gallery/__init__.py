@@ -1,5 +1,6 @@
 from functools import partial
 from flask import Blueprint
+from flamaster.core.session import exempt_session
 from flamaster.core.utils import add_api_rule, add_url_rule
 
 bp = Blueprint('gallery', __name__, url_prefix='/gallery')
@@ -10,4 +11,8 @@ def add_resource(endpoint, pk_def, import_name):
     return add_api_rule(bp, endpoint, pk_def, import_name)
 
 add_resource('images', {'id': None}, 'flamaster.gallery.api.ImageResource')
-add_url('/<img_id>/<geometry>', 'thumbnail')
+# thumbnail of the image never changes for the same geometry, but it is
+# served for private images as well, so only browsers may keep it
+add_url('/<img_id>/<geometry>', 'thumbnail',
+        http_cache={'max_age': 86400, 'public': False})
+exempt_session('gallery.thumbnail')
@@ -89,12 +89,15 @@ class ImageResource(ModelResource):
             return query.filter(or_(self.model.author_id == current_user.id,
                                        self.model.is_public is True))
 
-    @classmethod
-    def serialize(cls, instance, include=None):
+    def serializable_fields(self):
+        return super(ImageResource, self).serializable_fields() - \
+            set(['image'])
+
+    def serialize(self, instance, include=None):
         """ Method to controls model serialization in derived classes
         :rtype : dict
         """
-        return instance.as_dict(exclude=['image'])
+        return instance.as_dict(exclude=['image'], only=self.fields)
 
 
 class AlbumResource(ImageResource):
@@ -1,5 +1,6 @@
 from flask import Blueprint
-from flamaster.core.utils import add_api_rule
+from flamaster.core.utils import (add_api_rule, set_http_cache, LazyResource,
+                                  LOCALE_VARY)
 
 from .exceptions import ShelfNotAvailable
 from .signals import *
@@ -36,14 +37,26 @@ class OrderStates(object):
 product = Blueprint('product', __name__, url_prefix='/product')
 
 
-def add_resource(endpoint, pk_def, import_name):
+def add_resource(endpoint, pk_def, import_name, **kwargs):
     return add_api_rule(product, endpoint, pk_def,
-                        'flamaster.product.api.{}'.format(import_name))
-
-
-add_resource('categories', {'id': int}, 'CategoryResource')
-add_resource('countries', {'id': int}, 'CountryResource')
-
-
-
-
+                        'flamaster.product.api.{}'.format(import_name),
+                        **kwargs)
+
+
+add_resource('categories', {'id': int}, 'CategoryResource',
+             http_cache={'max_age': 60, 's_maxage': 300,
+                         'stale_while_revalidate': 60, 'vary': LOCALE_VARY})
+add_resource('countries', {'id': int}, 'CountryResource',
+             http_cache={'max_age': 3600, 's_maxage': 86400,
+                         'stale_while_revalidate': 3600,
+                         'vary': LOCALE_VARY})
+product.add_url_rule('/search/', 'search', methods=['GET'],
+                     view_func=LazyResource(
+                         'flamaster.product.api.ProductSearchResource',
+                         'search'))
+product.add_url_rule('/suggest/', 'suggest', methods=['GET'],
+                     view_func=LazyResource(
+                         'flamaster.product.api.SuggestResource', 'suggest'))
+set_http_cache('product.suggest', {'max_age': 60, 'vary': LOCALE_VARY})
+
+from . import indexes
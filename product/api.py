@@ -1,20 +1,32 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
+import math
 import trafaret as t
+from requests.exceptions import ConnectionError, Timeout
+from sqlamp import MovingToDescendantError
+
+from flask import abort, g, request
 
 from flamaster.core import http
-from flamaster.core.decorators import method_wrapper
-from flamaster.core.resources import ModelResource
+from flamaster.core.decorators import current_language, method_wrapper
+from flamaster.core.indexer import index
+from flamaster.core.resources import ModelResource, Resource
+from flamaster.core.utils import jsonify_status_code
 
+from .documents import BaseProduct
 from .helpers import resolve_parent
 from .models import Category, Country
+from .suggest import suggester
 
 
-__all__ = ['CategoryResource', 'CountryResource']
+__all__ = ['CategoryResource', 'CountryResource', 'ProductSearchResource',
+           'SuggestResource']
 
 
 class CategoryResource(ModelResource):
     page_size = 10000
+    streaming = True
+    cache_policy = {'get': 300}
     model = Category
 
     validation = t.Dict({
@@ -27,14 +39,47 @@ class CategoryResource(ModelResource):
         .ignore_extra('*')
 
     filters_map = t.Dict({
-        'parent_id': t.Int(gt=0)
-    }).make_optional('parent_id').ignore_extra('*')
+        'parent_id': t.Int(gt=0),
+        'subtree': t.Int(gt=0),
+    }).make_optional('parent_id', 'subtree').ignore_extra('*')
+
+    subtree = None
+
+    def _filter(self, query_kwargs):
+        query_kwargs = super(CategoryResource, self)._filter(query_kwargs)
+        self.subtree = query_kwargs.pop('subtree', None)
+        return query_kwargs
+
+    def get_objects(self, **kwargs):
+        """ Categories of the whole subtree are listed with the ``subtree``
+            argument, ids are taken from the tree snapshot
+        """
+        objects = super(CategoryResource, self).get_objects(**kwargs)
+        if self.subtree is None:
+            return objects
+
+        snapshot = self.model.snapshot()
+        if self.subtree not in snapshot:
+            abort(http.NOT_FOUND)
+        subtree = snapshot.descendants(self.subtree, and_self=True)
+        return objects.filter(self.model.id.in_(subtree))
+
+    @method_wrapper(http.ACCEPTED)
+    def put(self, id):
+        data = self.clean(g.request_data)
 
+        try:
+            return self.serialize(self.get_object(id).update(**data))
+        except MovingToDescendantError:
+            raise t.DataError({
+                'parent_id': "Category can't be moved into own subtree"
+            })
 
 
 class CountryResource(ModelResource):
     model = Country
     page_size = 1000
+    cache_policy = {'get': 3600}
 
     @method_wrapper(http.METHOD_NOT_ALLOWED)
     def put(self, id, data):
@@ -48,10 +93,168 @@ class CountryResource(ModelResource):
     def delete(self, id, data):
         return ''
 
-    @classmethod
-    def serialize(cls, instance):
+    def serialize(self, instance, include=None):
         """ Method to controls model serialization in derived classes
         :rtype : dict
         """
-        return instance.as_dict(include=['id', 'short', 'name'])
+        return instance.as_dict(include=['id', 'short', 'name'],
+                                only=self.fields)
+
+
+class ProductSearchResource(Resource):
+    """ Full text search of products. Hits, counts of the category facets
+        and the price histogram are answered by the single elasticsearch
+        query, hits are returned as they are stored in the index
+    """
+    page_size = 20
+    max_page_size = 100
+    # width of the price histogram buckets
+    price_interval = 10
+
+    arguments = t.Dict({
+        t.Key('q', optional=True): t.String,
+        t.Key('category', optional=True): t.Int(gt=0),
+        t.Key('price_min', optional=True): t.Float(gte=0),
+        t.Key('price_max', optional=True): t.Float(gte=0),
+        t.Key('price_interval', optional=True): t.Float(gt=0),
+        t.Key('page', default=1): t.Int(gt=0),
+        t.Key('page_size', optional=True): t.Int(gt=0),
+    }).ignore_extra('*')
+
+    def get(self):
+        try:
+            args = self.arguments.check(request.args.to_dict())
+        except t.DataError as err:
+            return jsonify_status_code(err.as_dict(), http.BAD_REQUEST)
+
+        snapshot = Category.snapshot()
+        category = args.get('category')
+        if category is not None and category not in snapshot:
+            abort(http.NOT_FOUND)
+
+        page_size = min(args.get('page_size', self.page_size),
+                        self.max_page_size)
+        interval = args.get('price_interval', self.price_interval)
+        facets = snapshot.children(category)
+        body = {
+            'query': self.build_query(args, snapshot),
+            'aggs': self.build_aggregations(snapshot, facets, interval),
+            'from': (args['page'] - 1) * page_size,
+            'size': page_size,
+        }
+
+        try:
+            result = index.backend(BaseProduct).search(body)
+        except (ConnectionError, Timeout):
+            return jsonify_status_code({}, http.SERVICE_UNAVAILABLE)
+
+        return jsonify_status_code(self.build_response(result, facets,
+                                                       interval, page_size))
+
+    def build_query(self, args, snapshot):
+        if args.get('q'):
+            lang = current_language()
+            match = {'multi_match': {
+                'query': args['q'],
+                'fields': ['name.{}^3'.format(lang), 'teaser.{}'.format(lang),
+                           'description.{}'.format(lang)],
+            }}
+        else:
+            match = {'match_all': {}}
+
+        filters = []
+        if args.get('category') is not None:
+            filters.append(self.category_filter(snapshot, args['category']))
+        # products whose price range overlaps the requested one
+        price_min, price_max = args.get('price_min'), args.get('price_max')
+        if price_min is not None:
+            filters.append({'range': {'max_price': {'gte': price_min}}})
+        if price_max is not None:
+            filters.append({'range': {'min_price': {'lte': price_max}}})
+
+        return {'bool': {'must': match, 'filter': filters}}
+
+    def category_filter(self, snapshot, category_id):
+        """ Products are listed in the category along with its subcategories
+        """
+        return {'terms': {
+            'categories': snapshot.descendants(category_id, and_self=True)
+        }}
+
+    def build_aggregations(self, snapshot, facets, interval):
+        aggs = {
+            'prices': {'histogram': {'field': 'min_price',
+                                     'interval': interval,
+                                     'min_doc_count': 1}},
+            'min_price': {'min': {'field': 'min_price'}},
+            'max_price': {'max': {'field': 'max_price'}},
+        }
+        if facets:
+            aggs['categories'] = {'filters': {'filters': dict(
+                (str(category_id), self.category_filter(snapshot, category_id))
+                for category_id in facets
+            )}}
+        return aggs
+
+    def build_response(self, result, facets, interval, page_size):
+        hits, aggs = result['hits'], result.get('aggregations', {})
+        total = hits['total']
+        if isinstance(total, dict):
+            # elasticsearch 7 reports total as {'value': .., 'relation': ..}
+            total = total['value']
+
+        buckets = aggs.get('categories', {}).get('buckets', {})
+        categories = [{'id': category_id,
+                       'count': buckets[str(category_id)]['doc_count']}
+                      for category_id in facets
+                      if buckets.get(str(category_id), {}).get('doc_count')]
+        prices = [{'from': bucket['key'], 'to': bucket['key'] + interval,
+                   'count': bucket['doc_count']}
+                  for bucket in aggs.get('prices', {}).get('buckets', [])]
+
+        return {
+            'meta': {
+                'total': total,
+                'pages': int(math.ceil(total / float(page_size))),
+                'quantity': page_size,
+            },
+            'objects': [dict(hit['_source'], id=hit['_id'])
+                        for hit in hits['hits']],
+            'facets': {
+                'categories': categories,
+                'prices': {
+                    'min': aggs.get('min_price', {}).get('value'),
+                    'max': aggs.get('max_price', {}).get('value'),
+                    'histogram': prices,
+                },
+            },
+        }
+
+
+class SuggestResource(Resource):
+    """ Type-ahead suggestions of products, categories and flat pages with
+        names starting from the typed text, answered from the prefix index
+        kept by the process
+    """
+    limit = 10
+    max_limit = 50
+
+    arguments = t.Dict({
+        'q': t.String,
+        t.Key('limit', optional=True): t.Int(gt=0),
+        t.Key('type', optional=True): t.String,
+    }).ignore_extra('*')
+
+    def get(self):
+        try:
+            args = self.arguments.check(request.args.to_dict())
+        except t.DataError as err:
+            return jsonify_status_code(err.as_dict(), http.BAD_REQUEST)
 
+        types = args.get('type') and args['type'].split(',') or None
+        limit = min(args.get('limit', self.limit), self.max_limit)
+        suggestions = suggester.lookup(args['q'], current_language(), limit,
+                                       types)
+        return jsonify_status_code({
+            'objects': [suggestion._asdict() for suggestion in suggestions]
+        })
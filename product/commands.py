@@ -0,0 +1,28 @@
+from __future__ import absolute_import
+
+from flask.ext.script import Command, Option
+
+from flamaster.core.commands import report
+
+from .suggest import suggester
+
+
+__all__ = ['SuggestCommand']
+
+
+class SuggestCommand(Command):
+    """ Builds the type-ahead suggestions, with ``--watch`` keeps rebuilding
+        them whenever products, categories or flat pages are changed
+    """
+
+    def run(self, watch=False, interval=60):
+        if watch:
+            suggester.work(interval, report=report)
+        else:
+            report("{} suggestions built".format(suggester.rebuild()))
+
+    def get_options(self):
+        return (
+            Option('--watch', action="store_true", dest='watch'),
+            Option('--interval', type=float, default=60, dest='interval'),
+        )
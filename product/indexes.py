@@ -0,0 +1,40 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+from flamaster.core.indexer import MongoDocumentIndex, index
+
+from .documents import BaseProduct
+
+
+__all__ = ['ProductIndex']
+
+
+class ProductIndex(MongoDocumentIndex):
+    """ Products are indexed with the price range of their variants, so
+        they could be filtered and aggregated by price
+    """
+    index_type = 'products'
+
+    def prices(self, product):
+        variants = product.product_variants
+        if not variants:
+            return {'min_price': None, 'max_price': None}
+        return {
+            'min_price': float(min(v.min_price for v in variants)),
+            'max_price': float(max(v.max_price for v in variants)),
+        }
+
+    def serialize(self, document):
+        iobject = document.as_dict(exclude=['product_variants'])
+        iobject.update(self.prices(document))
+        return self.localize(iobject)
+
+    def partial(self, document, fields):
+        fields = set(fields)
+        iobject = document.as_dict(only=fields - {'product_variants'})
+        if 'product_variants' in fields:
+            iobject.update(self.prices(document))
+        return self.localize(iobject)
+
+
+index.add(BaseProduct, ProductIndex)
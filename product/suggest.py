@@ -0,0 +1,190 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import re
+import time
+import zlib
+from bisect import bisect_left
+from collections import namedtuple
+from threading import Lock
+
+from flask import current_app
+
+from flamaster.core.cache import get_versions, invalidate, model_tags
+from flamaster.core.utils import by_languages
+from flamaster.extensions import db, redis
+from flamaster.flatpages.models import FlatPage
+
+from .documents import BaseProduct
+from .models import Category
+
+
+__all__ = ['Suggestion', 'PrefixIndex', 'Suggester', 'suggester']
+
+
+Suggestion = namedtuple('Suggestion', 'type id label')
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    return u' '.join(WORDS.findall(unicode(text).lower()))
+
+
+class PrefixIndex(object):
+    """ Labels of the locale searchable by the prefix of any of their
+        words. Keys, the label tails starting from every word, are kept in
+        the sorted array along with the positions of their suggestions, so
+        the lookup is the binary search and the scan of the matching range.
+        Suggestions with the label starting by the prefix go first
+    """
+
+    def __init__(self, suggestions):
+        self.suggestions = suggestions
+        starts, tails = [], []
+
+        for position, suggestion in enumerate(suggestions):
+            label = normalize(suggestion.label)
+            starts.append((label, position))
+            for word in WORDS.finditer(label):
+                if word.start():
+                    tails.append((label[word.start():], position))
+
+        starts.sort()
+        tails.sort()
+        self.starts = [key for key, _ in starts], [p for _, p in starts]
+        self.tails = [key for key, _ in tails], [p for _, p in tails]
+
+    def __len__(self):
+        return len(self.suggestions)
+
+    def lookup(self, prefix, limit=10, types=None):
+        prefix, found = normalize(prefix), []
+        if not prefix:
+            return found
+
+        seen = set()
+        for keys, positions in (self.starts, self.tails):
+            index = bisect_left(keys, prefix)
+            while index < len(keys) and keys[index].startswith(prefix):
+                position = positions[index]
+                suggestion = self.suggestions[position]
+                index += 1
+                if position in seen or (types and
+                                        suggestion.type not in types):
+                    continue
+                seen.add(position)
+                found.append(suggestion)
+                if len(found) >= limit:
+                    return found
+        return found
+
+
+class Suggester(object):
+    """ Prefix indices of products, categories and flat pages names by
+        locales. Indices are built by the `rebuild` job and stored in redis,
+        processes keep them in memory and swap them for the new ones once
+        the suggestions version is bumped, so suggestions are answered
+        without querying the databases
+    """
+    tag = 'suggest'
+    key = 'suggest:data'
+
+    def __init__(self):
+        self.version = None
+        self.indices = {}
+        self._lock = Lock()
+
+    def lookup(self, prefix, locale, limit=10, types=None):
+        version, = get_versions(self.tag)
+
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.indices = self._load()
+                    self.version = version
+
+        index = self.indices.get(locale)
+        if index is None:
+            return []
+        return index.lookup(prefix, limit, types)
+
+    def _load(self):
+        data = redis.get(self.key)
+        if data is None:
+            return {}
+        labels = json.loads(zlib.decompress(data))
+        return dict((locale, PrefixIndex([Suggestion(*s) for s in rows]))
+                    for locale, rows in labels.iteritems())
+
+    # -- building --
+
+    def sources(self):
+        """ Invalidation tags of the models suggestions are built from
+        """
+        return (model_tags(Category) + model_tags(FlatPage) +
+                model_tags(BaseProduct))
+
+    def collect(self, locales):
+        suggestions = dict((locale, []) for locale in locales)
+
+        def add(locale, type, id, label):
+            if label and locale in suggestions:
+                suggestions[locale].append((type, id, label))
+
+        # multilingual names are stored as [{'lang': 'en_US', 'value': ..}]
+        products = BaseProduct._get_collection().find({}, {'name': 1})
+        for product in products:
+            names = product.get('name') or []
+            if isinstance(names, basestring):
+                names = dict.fromkeys(locales, names)
+            else:
+                names = by_languages(dict((name['lang'], name['value'])
+                                          for name in names))
+            for locale, label in names.iteritems():
+                add(locale, 'product', str(product['_id']), label)
+
+        localized = Category.__localized__
+        rows = db.session.query(localized.locale, localized.parent_id,
+                                localized.name) \
+            .join(Category, Category.id == localized.parent_id) \
+            .filter(Category.is_deleted == False,
+                    Category.is_visible == True)
+        for locale, id, label in rows:
+            add(locale, 'category', id, label)
+
+        # flat pages aren't translated
+        for id, label in db.session.query(FlatPage.id, FlatPage.name):
+            for locale in locales:
+                add(locale, 'page', id, label)
+
+        return suggestions
+
+    def rebuild(self):
+        """ Collects labels of the suggestions and publishes them for the
+            processes answering them, returns amount of suggestions
+        """
+        locales = current_app.config['LANGUAGES'].keys()
+        suggestions = self.collect(locales)
+        data = zlib.compress(json.dumps(suggestions))
+
+        redis.set(self.key, data)
+        invalidate(self.tag)
+        return sum(map(len, suggestions.values()))
+
+    def work(self, interval=60, report=None):
+        """ Rebuilds suggestions as soon as the data they are built from is
+            changed, checking it every `interval` seconds
+        """
+        built = None
+        while True:
+            versions = get_versions(*self.sources())
+            if versions != built:
+                count = self.rebuild()
+                built = versions
+                if report is not None:
+                    report("{} suggestions built".format(count))
+            time.sleep(interval)
+
+
+suggester = Suggester()
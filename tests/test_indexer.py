@@ -0,0 +1,60 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+import unittest
+
+from bson import ObjectId
+from flask import Flask
+
+from flamaster.core import indexer
+from flamaster.product.documents import BaseProduct
+from flamaster.product.indexes import ProductIndex
+
+
+class RecordingClient(object):
+    """ Keeps the update requests instead of sending them
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, index, doc_type, id, **kwargs):
+        self.updates.append((index, id, kwargs))
+
+
+class UpdateFieldsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(LANGUAGES={'de': u'Deutsch', 'en': u'English'},
+                               MONGODB_FALLBACK_LANG='de')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.search_engine = indexer.search_engine
+        indexer.search_engine = self.client = RecordingClient()
+        self.index = ProductIndex()
+        self.index.indices = lambda: ['products']
+        self.product = BaseProduct(id=ObjectId(), sku='A-1', type='product',
+                                   name={'de': u'Sessel', 'en': u'Chair'},
+                                   created_by=1)
+
+    def tearDown(self):
+        indexer.search_engine = self.search_engine
+        self.context.pop()
+
+    def test_values_merged(self):
+        self.assertTrue(self.index.update_fields(self.product, ['sku']))
+        self.assertEqual(self.client.updates, [
+            ('products', str(self.product.id), {'doc': {'sku': 'A-1'}})])
+
+    def test_multilingual_replaced(self):
+        self.assertTrue(self.index.update_fields(self.product, ['name']))
+        (name, id, update), = self.client.updates
+        self.assertEqual(update['script']['source'],
+                         ProductIndex.assign_script)
+        self.assertEqual(update['script']['params'], {'fields': {
+            'name': {'de': u'Sessel', 'en': u'Chair'}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+
+from bson import ObjectId
+from flask import Flask
+
+from flamaster.core.embedded import EmbeddedIndex
+from flamaster.product.api import ProductSearchResource
+from flamaster.product.documents import (BasePriceOption, BaseProduct,
+                                         BaseProductVariant)
+from flamaster.product.indexes import ProductIndex
+
+
+class ProductSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(LANGUAGES={'de': u'Deutsch', 'en': u'English'},
+                               MONGODB_FALLBACK_LANG='de',
+                               INDEX_EMBEDDED_PATH=self.path)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.index = EmbeddedIndex(ProductIndex())
+
+    def tearDown(self):
+        self.context.pop()
+        shutil.rmtree(self.path)
+
+    def product(self, name, *prices):
+        variants = [BaseProductVariant(price_options=[
+            BasePriceOption(name={'de': u'Preis'}, price=Decimal(price))])
+            for price in prices]
+        return BaseProduct(id=ObjectId(), name=name, type='product',
+                           created_by=1, product_variants=variants)
+
+    def search(self, q):
+        # outside of requests the default language, `de`, is searched
+        query = ProductSearchResource().build_query({'q': q}, None)
+        result = self.index.search({'query': query})
+        return [hit['_id'] for hit in result['hits']['hits']]
+
+    def test_serialize_multilingual(self):
+        product = self.product({'de': u'Roter Sessel', 'en': u'Red chair'})
+        iobject = ProductIndex().serialize(product)
+        self.assertEqual(iobject['name'], {'de': u'Roter Sessel',
+                                           'en': u'Red chair'})
+
+    def test_serialize_fallback(self):
+        product = self.product({'de': u'Roter Sessel'})
+        iobject = ProductIndex().serialize(product)
+        self.assertEqual(iobject['name'], {'de': u'Roter Sessel',
+                                           'en': u'Roter Sessel'})
+
+    def test_find_by_name(self):
+        product = self.product({'de': u'Roter Sessel', 'en': u'Red chair'})
+        other = self.product({'de': u'Blaue Lampe', 'en': u'Blue lamp'})
+        for document in (product, other):
+            self.index.create(BaseProduct, document)
+
+        self.assertEqual(self.search(u'Sessel'), [str(product.id)])
+        self.assertEqual(self.search(u'lampe'), [str(other.id)])
+        # texts of other languages aren't searched
+        self.assertEqual(self.search(u'chair'), [])
+
+    def test_price_facets(self):
+        for document in (self.product({'de': u'Roter Sessel'}, 5, 12),
+                         self.product({'de': u'Grauer Sessel'}, 31),
+                         self.product({'de': u'Blaue Lampe'}, 8)):
+            self.index.create(BaseProduct, document)
+
+        resource = ProductSearchResource()
+        result = self.index.search({
+            'query': resource.build_query({'q': u'sessel'}, None),
+            'aggs': resource.build_aggregations(None, [], 10),
+        })
+        response = resource.build_response(result, [], 10, 20)
+
+        self.assertEqual(response['meta']['total'], 2)
+        self.assertEqual(response['facets']['prices'], {
+            'min': 5.0,
+            'max': 31.0,
+            'histogram': [{'from': 0, 'to': 10, 'count': 1},
+                          {'from': 30, 'to': 40, 'count': 1}],
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()